@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# buildTeamIndex.py
+#
+# Build the team -> repo permission index of every source org in a batch, so
+# migratePermissions.py can read team permissions from it instead of asking
+# GHES for the teams of every repo.
+#
+# Takes a list of source,destination org/repo pairs of repositories from STDIN
+#
+# Accepts either:
+#  source,destination org/repo pairs of repositories
+#  destination org/repo pair of repositories
+#
+# Usage:
+#     TEAM_INDEX_DIR=data/teams scripts/buildTeamIndex.py < data/repoListPairs.txt
+#     TEAM_INDEX_DIR=data/teams scripts/migratePermissions.py < data/repoListPairs.txt
+
+import sys
+
+import utils
+from utils import COMMENT_RE
+
+"""
+# Required Environment Variables
+export GH_SOURCE_PAT=<The Personal Access Token from GHES>
+export TEAM_INDEX_DIR=<directory to save the team indexes in>
+"""
+
+logger = utils.getLogger()
+
+sourceToken = utils.assertGetenv(
+    "GH_SOURCE_PAT", "Provide a GitHub Enterprise Server personal access token"
+)
+teamIndexDir = utils.assertGetenv(
+    "TEAM_INDEX_DIR", "Provide a directory to save the team indexes in"
+)
+sourceHeaders = utils.ghHeaders(sourceToken)
+
+# BEGIN main logic of script
+sourceOrgs = {
+    utils.getOrgAndRepoPairs(line)[0]
+    for line in sys.stdin
+    if not COMMENT_RE.match(line)
+}
+for sourceOrg in sorted(sourceOrgs):
+    utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+    index = utils.buildTeamRepoIndex(sourceOrg, sourceHeaders, logger)
+    utils.writeTeamRepoIndex(teamIndexDir, sourceOrg, index)
+    logger.info(
+        "Saved the team permissions of {} repos in {} to {}".format(
+            len(index), sourceOrg, utils.getTeamRepoIndexPath(teamIndexDir, sourceOrg)
+        )
+    )
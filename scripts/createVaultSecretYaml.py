@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # createVaultSecretYaml.py
 
+import hookRules
 import pandas as pd
 import utils
 import yaml
@@ -13,8 +14,7 @@ export VAULT_TOKEN=<a valid Vault Token>
 logger = utils.getLogger()
 
 vaultToken = utils.assertGetenv("VAULT_TOKEN", "Provide a Vault token")
-vaultHeaders = {"X-VAULT-TOKEN": f"{vaultToken}"}
-vaultUri = "https://vault.example.com:8200/v1/secret/data"
+vaultClient = utils.getVaultClient(vaultToken)
 
 
 def write_yaml_to_file(py_obj, filename):
@@ -42,13 +42,12 @@ result = data.loc[data["IP Type"] != "PUBLIC", "hook"]
 hostNamelist = result.tolist()
 secretDataList = []
 
+# Read the existing secrets in bulk, then create only the missing ones
+utils.prefetchVaultSecrets(logger, vaultClient)
+utils.ensureVaultSecrets(logger, vaultClient, hostNamelist, hookRules.isDevDestination)
 
 for host in hostNamelist:
     vaultPath = utils.getVaultPath(host)
-    mount_point = utils.getVaultMountpoint(host)
-    hmacSecret = utils.readOrCreateVaultSecret(
-        logger, vaultUri, vaultHeaders, vaultPath, mount_point
-    )
     vaultSecretName = vaultPath.split("/", 1)[1]
 
     secretData = {
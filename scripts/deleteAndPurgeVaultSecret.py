@@ -11,11 +11,8 @@ scripts/deleteAndPurgeVaultSecret.py \
 """
 import argparse
 
-import hvac
 import utils
 
-vaultUrl = "https://vault.example.com:8200"
-
 logger = utils.getLogger()
 
 parser = argparse.ArgumentParser()
@@ -35,10 +32,7 @@ else:
         "VAULT_TOKEN", "Specify a Vault token. See scripts/getVaultToken.sh"
     )
 
-client = hvac.Client(
-    url=vaultUrl,
-    token=vaultToken,
-)
+client = utils.getVaultClient(vaultToken)
 
 
 res = client.secrets.kv.delete_metadata_and_all_versions(
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# dnsResolver.py
+#
+# Resolve and classify webhook domains as public, private or unresolvable.
+#
+# Domains are resolved concurrently, each with its own timeout, and every
+# domain is only resolved once per process. Results can also be cached on disk
+# for a while, so reruns and other scripts do not resolve them again.
+# Domains that do not exist are only cached for a short while, and lookups
+# that time out or fail temporarily are not cached at all.
+#
+# Optional Environment Variables
+#     export DNS_CACHE_FILE=<JSON file to cache DNS results in>
+#     export DNS_CACHE_TTL=<seconds to trust cached DNS results - a day by default>
+#     export DNS_NEGATIVE_CACHE_TTL=<seconds to trust cached unresolvable domains - 5 minutes by default>
+
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+PUBLIC = "PUBLIC"
+PRIVATE = "PRIVATE"
+UNRESOLVABLE = "UNRESOLVABLE"
+
+DEFAULT_RESOLVE_TIMEOUT = 5
+DEFAULT_WORKERS = 32
+DEFAULT_TTL = int(os.getenv("DNS_CACHE_TTL", str(24 * 60 * 60)))
+DEFAULT_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_CACHE_TTL", str(5 * 60)))
+
+# Resolver errors meaning the domain does not exist or has no address, as
+# opposed to the resolver failing
+NEGATIVE_ERRNOS = {
+    errno
+    for errno in (
+        getattr(socket, "EAI_NONAME", None),
+        getattr(socket, "EAI_NODATA", None),
+    )
+    if errno is not None
+}
+
+# domain -> {"ip": ..., "type": ..., "resolvedAt": ...}
+_cache: dict = {}
+_cacheLock = threading.Lock()
+_loadedCacheFiles: set = set()
+# Created on first use. Lookups that time out keep running in it, so it is
+# not shut down when a call returns.
+_executor = None
+
+
+def getExecutor():
+    global _executor
+    with _cacheLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS)
+        return _executor
+
+
+def classifyDomain(domain):
+    """Return the IP and type of a domain. Failures that may not happen
+    again are marked transient, so they are not cached."""
+    try:
+        ip = socket.gethostbyname(domain)
+    except UnicodeError as err:
+        return {"ip": None, "type": UNRESOLVABLE, "error": str(err)}
+    except socket.gaierror as err:
+        result = {"ip": None, "type": UNRESOLVABLE, "error": str(err)}
+        if err.errno not in NEGATIVE_ERRNOS:
+            result["transient"] = True
+        return result
+    if ipaddress.ip_address(ip).is_private:
+        return {"ip": ip, "type": PRIVATE}
+    return {"ip": ip, "type": PUBLIC}
+
+
+def timedClassifyDomain(domain, started):
+    started[domain] = time.monotonic()
+    return classifyDomain(domain)
+
+
+def isFresh(result, now, ttl, negativeTtl):
+    if result["type"] == UNRESOLVABLE:
+        ttl = negativeTtl
+    return now - result["resolvedAt"] < ttl
+
+
+def loadCacheFile(cacheFile, ttl, negativeTtl, logger):
+    if cacheFile in _loadedCacheFiles:
+        return
+    _loadedCacheFiles.add(cacheFile)
+    try:
+        with open(cacheFile, "r") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    fresh = {
+        domain: result
+        for domain, result in cached.items()
+        if isFresh(result, now, ttl, negativeTtl)
+    }
+    logger.debug(f"Loaded {len(fresh)} fresh DNS results from {cacheFile}")
+    with _cacheLock:
+        for domain, result in fresh.items():
+            _cache.setdefault(domain, result)
+
+
+def saveCacheFile(cacheFile):
+    with _cacheLock:
+        cached = dict(_cache)
+    with open(cacheFile, "w") as f:
+        json.dump(cached, f, indent=2, sort_keys=True)
+
+
+def cacheResults(results):
+    """Timestamp fresh results and cache the ones that are not transient."""
+    resolvedAt = time.time()
+    stamped = {
+        domain: {**result, "resolvedAt": resolvedAt}
+        for domain, result in results.items()
+    }
+    with _cacheLock:
+        for domain, result in stamped.items():
+            if not result.get("transient"):
+                _cache[domain] = result
+    return stamped
+
+
+def resolveDomains(
+    domains,
+    logger,
+    timeout=DEFAULT_RESOLVE_TIMEOUT,
+    cacheFile=os.getenv("DNS_CACHE_FILE"),
+    ttl=DEFAULT_TTL,
+    negativeTtl=DEFAULT_NEGATIVE_TTL,
+):
+    """Resolve and classify a set of domains, returning a dict keyed by domain.
+
+    Domains that are already known are not resolved again. The others are
+    resolved concurrently, and any lookup that takes longer than timeout
+    seconds is classified as unresolvable, without caching it."""
+    if cacheFile:
+        loadCacheFile(cacheFile, ttl, negativeTtl, logger)
+    now = time.time()
+    with _cacheLock:
+        known = {
+            domain: _cache[domain]
+            for domain in domains
+            if domain in _cache and isFresh(_cache[domain], now, ttl, negativeTtl)
+        }
+    unknown = set(domains) - set(known)
+    if unknown:
+        logger.info(f"Resolving {len(unknown)} domains")
+        executor = getExecutor()
+        started: dict = {}
+        pending = {
+            executor.submit(timedClassifyDomain, domain, started): domain
+            for domain in unknown
+        }
+        while pending:
+            done, _ = wait(pending, timeout=1)
+            now = time.monotonic()
+            results = {pending.pop(future): future.result() for future in done}
+            for future, domain in list(pending.items()):
+                if domain in started and now - started[domain] > timeout:
+                    # gethostbyname cannot be interrupted, so stop waiting
+                    del pending[future]
+                    results[domain] = {
+                        "ip": None,
+                        "type": UNRESOLVABLE,
+                        "error": f"timed out after {timeout} seconds",
+                        "transient": True,
+                    }
+            known.update(cacheResults(results))
+        if cacheFile:
+            saveCacheFile(cacheFile)
+    return {domain: known[domain] for domain in domains}
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# eciImports.py
+#
+# Resolve the user and team conflicts of GitHub Enterprise Cloud Importer
+# (ECI) migrations. Used by setEciImports.py for one migration, and by
+# setEciImportsBatch.py for many migrations at once.
+
+import functools as ft
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictWriter
+
+import utils
+from github import GithubException
+from python_graphql_client import GraphqlClient
+
+ECI_GRAPHQL_URL = "https://eci.github.com/api/graphql"
+GITHUB_TEAM = "migration_dummy_team"
+DEFAULT_MAPPING_BATCH_SIZE = 500
+DEFAULT_MAX_WAIT = 4 * 60 * 60
+# The migration states ECI reports, to warn about any others
+MIGRATION_STATES = {
+    "PENDING",
+    "UPLOADING",
+    "PREPARING",
+    "CONFLICTS",
+    "READY",
+    "IMPORTING",
+    "IMPORTED",
+    "FAILED",
+    "FAILED_IMPORT",
+    "UNLOCKED",
+}
+
+
+def make_get_query(migration_guid, org, after_cursor=None):
+    query = """
+query Organization {
+    organization(login: ORG) {
+        migration(guid: GUID) {
+            migratableResources(first: 100 AFTER) {
+                totalCount
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                edges {
+                    node {
+                        modelName
+                        sourceUrl
+                        targetUrl
+                        state
+                    }
+                }
+            }
+        }
+    }
+}
+"""
+    repls = (
+        ("AFTER", "{}".format(after_cursor)),
+        ("GUID", '"{}"'.format(migration_guid)),
+        ("ORG", '"{}"'.format(org)),
+    )
+    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+    return res
+
+
+def make_get_state_query(migration_guid, org):
+    query = """
+query Organization {
+    organization(login: ORG) {
+        migration(guid: GUID) {
+            state
+        }
+    }
+}
+"""
+    repls = (
+        ("GUID", '"{}"'.format(migration_guid)),
+        ("ORG", '"{}"'.format(org)),
+    )
+    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+    return res
+
+
+def make_set_query(migration_id, dict):
+    json_object = json.dumps(dict, indent=4)
+    query = """
+mutation AddImportMapping {
+    addImportMapping(
+        input: {
+            migrationId: MIGRATION_ID
+            mappings: JSONOBJECT
+        }
+    ) {
+        migration {
+            databaseId
+            guid
+            state
+        }
+    }
+}
+"""
+    repls = ("MIGRATION_ID", '"{}"'.format(migration_id)), (
+        "JSONOBJECT",
+        "{}".format(json_object),
+    )
+    multiline_string = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+    pattern = r'(?<!\w)"(modelName|sourceUrl|targetUrl|action|MAP|SKIP|MERGE)"(?!\w)'
+    res = re.sub(pattern, r"\1", multiline_string)
+    return res
+
+
+class EciSession:
+    """What the ECI migrations of one token share: the GraphQL client, the
+    identity index and, if given, a utils.TokenBucket pacing every query."""
+
+    def __init__(
+        self,
+        token,
+        logger,
+        identities,
+        bucket=None,
+        mapping_batch_size=DEFAULT_MAPPING_BATCH_SIZE,
+    ):
+        self.token = token
+        self.logger = logger
+        self.identities = identities
+        self.bucket = bucket
+        self.mapping_batch_size = mapping_batch_size
+        self.client = GraphqlClient(endpoint=ECI_GRAPHQL_URL)
+
+    def execute(self, query):
+        if self.bucket:
+            self.bucket.acquire()
+        return self.client.execute(
+            query=query,
+            headers={
+                "Authorization": "Bearer {}".format(self.token),
+                "Graphql-Features": "gh_migrator_import_to_dotcom",
+            },
+        )
+
+    def create_team(self, github_org, github_team=GITHUB_TEAM):
+        self.logger.info(
+            "Creating team - {} in org {}".format(github_team, github_org.login)
+        )
+        try:
+            github_org.create_team(github_team, privacy="closed", permission="push")
+        except GithubException as e:
+            self.logger.warning(e.args[1]["message"])
+
+    def get_state(self, org, migration_guid):
+        data = self.execute(make_get_state_query(migration_guid, org))
+        return data["data"]["organization"]["migration"]["state"]
+
+    def wait_for_state(
+        self,
+        org,
+        migration_guid,
+        wait_states,
+        initial_delay=5,
+        max_delay=300,
+        max_wait=DEFAULT_MAX_WAIT,
+    ):
+        """Poll a migration until it leaves wait_states, backing off
+        exponentially between polls, and return its state.
+
+        Raises utils.UnexpectedStateError if it is still in wait_states
+        after max_wait seconds."""
+        deadline = time.monotonic() + max_wait
+        delay = initial_delay
+        state = self.get_state(org, migration_guid)
+        while state in wait_states:
+            if time.monotonic() + delay > deadline:
+                raise utils.UnexpectedStateError(
+                    "Migration {} in {} is still {} after {}s".format(
+                        migration_guid, org, state, max_wait
+                    )
+                )
+            self.logger.info(
+                "Migration {} in {} is {}, checking again in {}s".format(
+                    migration_guid, org, state, delay
+                )
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            state = self.get_state(org, migration_guid)
+        if state not in MIGRATION_STATES:
+            self.logger.warning(
+                "Migration {} in {} is in unknown state {}".format(
+                    migration_guid, org, state
+                )
+            )
+        return state
+
+    def map_objects(self, dict, migration_id):
+        query = make_set_query(migration_id, dict)
+        data = self.execute(query)
+        self.logger.debug("{}".format(query))
+        if data.get("errors") or not data.get("data"):
+            raise utils.UnexpectedStateError(
+                "Could not map {} objects of migration {}: {}".format(
+                    len(dict), migration_id, data
+                )
+            )
+        self.logger.info("mapped {} objects: {}".format(len(dict), data))
+
+    def fetch_page(self, org, migration_guid, after_cursor):
+        data = self.execute(make_get_query(migration_guid, org, after_cursor))
+        return data["data"]["organization"]["migration"]["migratableResources"]
+
+    def map_and_record(self, batch, migration_id, writer):
+        """Map a batch, then write its user mappings to the CSV file, so the
+        file only lists mappings that were sent."""
+        self.map_objects(batch, migration_id)
+        for node in batch:
+            if node["action"] == "MAP":
+                writer.writerow({k: node[k] for k in ("sourceUrl", "targetUrl")})
+
+    def resolve_nodes(self, org, resources, github_team):
+        """Turn a page of migratable resources into user and team mappings."""
+        users_to_map = []
+        teams_to_merge = []
+        for model in resources["edges"]:
+            node = model["node"]
+            node["action"] = node.pop("state")
+            if node["modelName"] == "user":
+                user_name = node["sourceUrl"].split("github.example.com/", 1)[1]
+                cloud_user_name = self.identities.getCloudLogin(user_name, org)
+                node["modelName"] = "undefined"
+                if cloud_user_name:
+                    node["targetUrl"] = "https://github.com/{}".format(cloud_user_name)
+                    node["action"] = "MAP"
+                    users_to_map.append(node)
+            if node["modelName"] == "team":
+                node["targetUrl"] = "https://github.com/orgs/{}/teams/{}".format(
+                    org, github_team
+                )
+                node["action"] = "MERGE"
+                node["modelName"] = "undefined"
+                teams_to_merge.append(node)
+        return users_to_map, teams_to_merge
+
+    def take_batches(self, pending, last_page):
+        """Take the full batches of mappings out of pending, and after the
+        last page whatever is left."""
+        batches = []
+        for mappings in pending.values():
+            while len(mappings) >= self.mapping_batch_size or (last_page and mappings):
+                batches.append(mappings[: self.mapping_batch_size])
+                del mappings[: self.mapping_batch_size]
+        return batches
+
+    def fetch_and_resolve_conflicts(  # noqa: C901
+        self, org, migration_guid, migration_id, github_team, csv_file
+    ):
+        """Map the users and teams of a migration.
+
+        The next page of migratable resources is fetched while the current
+        one is resolved, and mappings are sent in batches of
+        mapping_batch_size from a second thread, so fetching and mutating
+        overlap."""
+        utils.ghRateLimitSleep(self.token, self.logger, instance="github.com")
+        self.identities.getMembers(org)
+
+        pending: dict = {"users": [], "teams": []}
+        mutations = []
+        with (
+            open(csv_file, "w") as import_file,
+            ThreadPoolExecutor(max_workers=1) as fetcher,
+            ThreadPoolExecutor(max_workers=1) as mutator,
+        ):
+            writer = DictWriter(import_file, fieldnames=["sourceUrl", "targetUrl"])
+            writer.writeheader()
+            try:
+                next_page = fetcher.submit(self.fetch_page, org, migration_guid, "")
+                while next_page:
+                    resources = next_page.result()
+                    page_info = resources["pageInfo"]
+                    if page_info["hasNextPage"]:
+                        after_cursor = ', after: "{}"'.format(page_info["endCursor"])
+                        next_page = fetcher.submit(
+                            self.fetch_page, org, migration_guid, after_cursor
+                        )
+                    else:
+                        next_page = None
+                    users_to_map, teams_to_merge = self.resolve_nodes(
+                        org, resources, github_team
+                    )
+                    pending["users"].extend(users_to_map)
+                    pending["teams"].extend(teams_to_merge)
+                    for batch in self.take_batches(pending, next_page is None):
+                        mutations.append(
+                            mutator.submit(
+                                self.map_and_record, batch, migration_id, writer
+                            )
+                        )
+                    # Stop at the first failed batch, not after the last page
+                    for mutation in [m for m in mutations if m.done()]:
+                        mutation.result()
+                        mutations.remove(mutation)
+                for mutation in mutations:
+                    mutation.result()
+            except Exception:
+                # Do not send the batches queued behind a failed one
+                for mutation in mutations:
+                    mutation.cancel()
+                raise
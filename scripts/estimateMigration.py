@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# estimateMigration.py
+#
+# Forecast the API consumption and wall-clock time of the post migration
+# scripts (migratePullRequests.py, migrateWebhook.py, migratePermissions.py and
+# migrateAppPermission.py) for a batch of repositories, using only cheap reads
+# against the source.
+#
+# Takes a list of source,destination org/repo pairs of repositories from STDIN
+#
+# Accepts either:
+#  source,destination org/repo pairs of repositories
+#  destination org/repo pair of repositories
+#
+# Usage:
+#     scripts/estimateMigration.py <<<"org/github-migration,example-org/github-migration"
+#     scripts/estimateMigration.py < data/repoListPairs.txt
+#
+# The estimate assumes nothing has been migrated yet, and that every comment
+# needs to be recreated, so it is an upper bound.
+
+import math
+import os
+import sys
+from collections import defaultdict
+
+import utils
+from python_graphql_client import GraphqlClient
+from utils import COMMENT_RE
+
+"""
+# Required Environment Variables
+export GH_SOURCE_PAT=<The Personal Access Token from GHES>
+
+# Optional Environment Variables, read the same way as migratePullRequests.py
+export CLOSED_PR_MODE=<gitdata, commit or issue - gitdata by default>
+export MUTATIONS_PER_MINUTE=<write budget shared by all repos, at most 80 - 12 by default>
+export REPO_CONCURRENCY=<how many repos to migrate at once - 1 by default>
+export READ_AHEAD=<how many PRs to prefetch from the source, at least 1 - 5 by default>
+# and the same way as migratePermissions.py
+export PERMISSION_WRITES_PER_MINUTE=<permission write budget - 60 by default>
+"""
+
+logger = utils.getLogger()
+
+sourceToken = utils.assertGetenv(
+    "GH_SOURCE_PAT", "Provide a GitHub Enterprise Server personal access token"
+)
+sourceHeaders = utils.ghHeaders(sourceToken)
+
+closedPrMode = utils.getenvChoice("CLOSED_PR_MODE", utils.CLOSED_PR_MODES, "gitdata")
+mutationsPerMinute = min(
+    int(os.getenv("MUTATIONS_PER_MINUTE", "12")), utils.GHEC_CONTENT_CREATION_PER_MINUTE
+)
+repoConcurrency = int(os.getenv("REPO_CONCURRENCY", "1"))
+readAhead = max(1, int(os.getenv("READ_AHEAD", "5")))
+permissionWritesPerMinute = int(os.getenv("PERMISSION_WRITES_PER_MINUTE", "60"))
+
+client = GraphqlClient(endpoint="https://github.example.com/api/graphql")
+
+# Seconds a plain REST or GraphQL round trip takes, for unpaced calls
+REQUEST_SECONDS = 0.5
+
+# Destination mutations needed per migrated object
+CLOSED_PR_MUTATIONS = {
+    # create branch, create PR, close it, delete branch
+    "gitdata": 4,
+    # create branch, commit, create PR, close it, delete branch
+    "commit": 5,
+    # create issue, close it
+    "issue": 2,
+}
+# create PR, then set its labels and milestone
+OPEN_PR_MUTATIONS = 2
+ISSUE_MUTATIONS = 1
+# migrateWebhook.py sends at most one PATCH per hook, after sleep(1)
+HOOK_MUTATIONS = 1
+HOOK_PACING_SECONDS = 1
+APP_PACING_SECONDS = 1
+
+REPO_BATCH_SIZE = 25
+
+
+def makeRepoCountsQuery(repoPairs):
+    fields = "\n".join(
+        f"""    r{i}: repository(owner: "{sourceOrg}", name: "{sourceRepo}") {{
+        open: pullRequests(states: OPEN) {{ totalCount }}
+        closed: pullRequests(states: CLOSED) {{ totalCount }}
+        merged: pullRequests(states: MERGED) {{ totalCount }}
+        issues {{ totalCount }}
+    }}"""
+        for i, (sourceOrg, sourceRepo, _, _) in enumerate(repoPairs)
+    )
+    query = f"""
+query Repositories {{
+{fields}
+}}
+"""
+    logger.debug(query)
+    return query
+
+
+def getRepoCounts(repoPairs):
+    """Count the PRs by state and the issues of each repo, a batch per query."""
+    counts = []
+    for i in range(0, len(repoPairs), REPO_BATCH_SIZE):
+        batch = repoPairs[i : i + REPO_BATCH_SIZE]
+        data = client.execute(
+            query=makeRepoCountsQuery(batch),
+            headers=utils.ghGraphqlHeaders(sourceToken),
+        )
+        for j, (sourceOrg, sourceRepo, _, _) in enumerate(batch):
+            repository = (data.get("data") or {}).get(f"r{j}")
+            if not repository:
+                logger.warning(f"No repo found at {sourceOrg}/{sourceRepo}, skipping")
+                counts.append(None)
+                continue
+            counts.append(
+                {
+                    key: repository[key]["totalCount"]
+                    for key in ["open", "closed", "merged", "issues"]
+                }
+            )
+    return counts
+
+
+def countRestItems(sourceOrg, sourceRepo, path, params=None):
+    url = f"{utils.GHES_API_URL}/repos/{sourceOrg}/{sourceRepo}/{path}"
+    return utils.ghCountItems(url, sourceHeaders, logger, params=params)
+
+
+def countSelectedAppInstalls(sourceOrg, installCache):
+    """Count the app installations of an org limited to selected repos."""
+    if sourceOrg not in installCache:
+        url = f"{utils.GHES_API_URL}/orgs/{sourceOrg}/installations"
+        installCache[sourceOrg] = sum(
+            1
+            for install in utils.ghGetPaginated(
+                url,
+                sourceHeaders,
+                logger,
+                params={"per_page": "100"},
+                key="installations",
+            )
+            if install["repository_selection"] == "selected"
+        )
+    return installCache[sourceOrg]
+
+
+def estimateRepo(sourceOrg, sourceRepo, counts, installCache):
+    """Apply the cost model to the counts of one repo."""
+    closedPrs = counts["closed"] + counts["merged"]
+    prs = counts["open"] + closedPrs
+    numbers = prs + counts["issues"]
+    comments = countRestItems(sourceOrg, sourceRepo, "issues/comments")
+    reviewComments = countRestItems(sourceOrg, sourceRepo, "pulls/comments")
+    hooks = countRestItems(sourceOrg, sourceRepo, "hooks")
+    collaborators = countRestItems(
+        sourceOrg, sourceRepo, "collaborators", params={"affiliation": "direct"}
+    )
+    teams = countRestItems(sourceOrg, sourceRepo, "teams")
+    appInstalls = countSelectedAppInstalls(sourceOrg, installCache)
+
+    prMutations = (
+        counts["open"] * OPEN_PR_MUTATIONS
+        + closedPrs * CLOSED_PR_MUTATIONS[closedPrMode]
+        + counts["issues"] * ISSUE_MUTATIONS
+        + comments
+        + reviewComments
+    )
+    estimate = {
+        "numbers": numbers,
+        "mutations": prMutations
+        + hooks * HOOK_MUTATIONS
+        + collaborators
+        + teams
+        + appInstalls,
+        # details, plus two rate limit probes, for each number, then the
+        # repo-wide comment, label and milestone listings
+        "restCalls": numbers * 3
+        + math.ceil((comments + reviewComments) / 100)
+        + 4
+        + hooks * HOOK_MUTATIONS * 2
+        + collaborators
+        + teams
+        + 4
+        + appInstalls * 2,
+        # number bitmap, branch index, open PR heads and latest PRs
+        "graphqlPoints": math.ceil(numbers / 100) + math.ceil(counts["open"] / 100) + 4,
+        # PR writes are paced by MUTATIONS_PER_MINUTE, shared by all repos
+        "pacedSeconds": prMutations * 60 / mutationsPerMinute,
+        # source reads sleep(1) each, READ_AHEAD of them at a time, behind
+        # the paced writes
+        "readSeconds": numbers * (1 + REQUEST_SECONDS) / readAhead,
+        # the other scripts are not paced by the shared budget
+        "otherSeconds": hooks * HOOK_MUTATIONS * (HOOK_PACING_SECONDS + REQUEST_SECONDS)
+        + (collaborators + teams) * max(60 / permissionWritesPerMinute, REQUEST_SECONDS)
+        + appInstalls * (APP_PACING_SECONDS + REQUEST_SECONDS),
+    }
+    logger.info(
+        f"{sourceOrg}/{sourceRepo}: {counts['open']} open, {closedPrs} closed PRs, "
+        f"{counts['issues']} issues, {comments} comments, {reviewComments} review comments, "
+        f"{hooks} hooks, {collaborators} collaborators, {teams} teams, "
+        f"up to {appInstalls} app installs"
+    )
+    logger.info(
+        f"{sourceOrg}/{sourceRepo}: about {estimate['mutations']} mutations, "
+        f"{estimate['restCalls']} REST calls, {estimate['graphqlPoints']} GraphQL points, "
+        f"{formatDuration(repoSeconds(estimate))}"
+    )
+    return estimate
+
+
+def repoSeconds(estimate):
+    return (
+        max(estimate["pacedSeconds"], estimate["readSeconds"])
+        + estimate["otherSeconds"]
+    )
+
+
+def formatDuration(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h{rest // 60:02d}m"
+
+
+# BEGIN main logic of script
+repoPairs = [
+    utils.getOrgAndRepoPairs(line) for line in sys.stdin if not COMMENT_RE.match(line)
+]
+utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+installCache: dict = {}
+totals: dict = defaultdict(int)
+longestPrSeconds = 0.0
+for repoPair, counts in zip(repoPairs, getRepoCounts(repoPairs)):
+    if not counts:
+        continue
+    utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+    estimate = estimateRepo(repoPair[0], repoPair[1], counts, installCache)
+    for key, value in estimate.items():
+        totals[key] += value
+    totals["repos"] += 1
+    longestPrSeconds = max(
+        longestPrSeconds, max(estimate["pacedSeconds"], estimate["readSeconds"])
+    )
+
+# Repos migrated concurrently share one mutation budget, so their PRs take at
+# least as long as all of the paced writes, and as long as the largest repo.
+# The other scripts handle one repo at a time.
+batchSeconds = (
+    max(
+        totals["pacedSeconds"],
+        totals["readSeconds"] / max(1, repoConcurrency),
+        longestPrSeconds,
+    )
+    + totals["otherSeconds"]
+)
+logger.info(
+    f"Batch of {totals['repos']} repos: about {totals['mutations']} mutations, "
+    f"{totals['restCalls']} REST calls, {totals['graphqlPoints']} GraphQL points, "
+    f"{formatDuration(batchSeconds)} with REPO_CONCURRENCY={repoConcurrency} "
+    f"and MUTATIONS_PER_MINUTE={mutationsPerMinute}"
+)
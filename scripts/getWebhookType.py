@@ -1,27 +1,30 @@
 #!/usr/bin/env python3
 # getWebhookType.py
+#
+# Optional Environment Variables
+#     export DNS_CACHE_FILE=<JSON file to cache DNS results in>
 
 import csv
-import socket
 
+import dnsResolver
+import utils
 from IPy import IP
 
+logger = utils.getLogger()
+
 fields = ["hook", "IP", "IP Type"]
 rows = []
 
 with open("hooks-unique-domain-sorted.txt", "r") as hooklst:
-    for line in hooklst:
-        try:
-            hook = line.strip()
-            result = socket.gethostbyname(hook)
-            ip = IP(result)
-            iptype = ip.iptype()
-            row = {"hook": hook, "IP": result, "IP Type": iptype}
-            rows.append(row)
-        except Exception:
-            row = {"hook": hook, "IP": "Unable to find Hostname", "IP Type": "null"}
-            rows.append(row)
-            pass
+    hooks = [line.strip() for line in hooklst]
+results = dnsResolver.resolveDomains(set(hooks), logger)
+for hook in hooks:
+    result = results[hook]
+    if result["ip"]:
+        row = {"hook": hook, "IP": result["ip"], "IP Type": IP(result["ip"]).iptype()}
+    else:
+        row = {"hook": hook, "IP": "Unable to find Hostname", "IP Type": "null"}
+    rows.append(row)
 with open("hooks-unique-domain-IP-map.csv", "w", newline="") as file:
     writer = csv.DictWriter(file, fieldnames=fields)
     writer.writeheader()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# hookRules.py
+#
+# The rules for rewriting webhook URLs during the migration, loaded from a data
+# file into sets and dicts the first time they are needed, so looking up a hook
+# is O(1) however many rules there are.
+#
+# The data file holds:
+#     replayDomains                env -> domain of the replay reverse proxy
+#     devHookDestinations          hook domains that go to the dev replay proxy
+#     orgHooks                     replayDomains and devHookDestinations for
+#                                  org hooks, which use their own replay proxy
+#     publicHookDomainsWithSecret  public hook domains which also have secrets
+#     oldToNewHostnames            hook hostnames that have been renamed
+#
+# Replay URLs of either replay proxy are decoded, whichever hooks they are on.
+#
+# Optional Environment Variables
+#     export HOOK_RULES_FILE=<JSON file with the rules - data/hookRules.json by default>
+
+import json
+import os
+import threading
+from urllib.parse import urlparse
+
+DEFAULT_RULES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "hookRules.json"
+)
+
+# Require HTTPS for webhook destinations
+PROTO = "https"
+
+# Path segments that replay URLs use before the encoded scheme, from both the
+# repo and the org hook scripts
+REPLAY_PATH_MARKERS = {"path", "replay_path"}
+
+
+# Which hooks a rule set is for
+REPO_HOOKS = "repo"
+ORG_HOOKS = "org"
+
+
+def loadRules(rulesFile=None):
+    with open(rulesFile or os.getenv("HOOK_RULES_FILE", DEFAULT_RULES_FILE)) as f:
+        data = json.load(f)
+    scopes = {REPO_HOOKS: data, ORG_HOOKS: data["orgHooks"]}
+    return {
+        "replayDomains": {
+            scope: scopeData["replayDomains"] for scope, scopeData in scopes.items()
+        },
+        "replayHosts": {
+            host
+            for scopeData in scopes.values()
+            for host in scopeData["replayDomains"].values()
+        },
+        "devHookDestinations": {
+            scope: set(scopeData["devHookDestinations"])
+            for scope, scopeData in scopes.items()
+        },
+        "publicHookDomainsWithSecret": set(data["publicHookDomainsWithSecret"]),
+        "oldToNewHostnames": data["oldToNewHostnames"],
+    }
+
+
+_rules = None
+_rulesLock = threading.Lock()
+
+
+def getRules():
+    """Load the rules on first use, so importing this module never fails."""
+    global _rules
+    with _rulesLock:
+        if _rules is None:
+            _rules = loadRules()
+        return _rules
+
+
+def isDevDestination(hookDomain, scope=REPO_HOOKS):
+    return hookDomain in getRules()["devHookDestinations"][scope]
+
+
+def isPublicWithSecret(hookDomain):
+    return hookDomain in getRules()["publicHookDomainsWithSecret"]
+
+
+def decodeReplayUrl(hookUrl):
+    """Return the URL a replay URL forwards to, the URL itself if it is not a
+    replay URL, or None if it is a replay URL in an unfamiliar format."""
+    parsed = urlparse(hookUrl)
+    if parsed.netloc not in getRules()["replayHosts"]:
+        return hookUrl
+    # /<reverse proxy>/<marker>/<scheme>/<rest of the url>
+    segments = parsed.path.split("/", 4)
+    if len(segments) < 5 or segments[2] not in REPLAY_PATH_MARKERS:
+        return None
+    decoded = "{}://{}".format(segments[3], segments[4])
+    if parsed.query:
+        decoded = "{}?{}".format(decoded, parsed.query)
+    return decoded
+
+
+def encodeReplayUrl(hookUrl, hookDomain, prefix="reverse-proxy", scope=REPO_HOOKS):
+    """Return the replay URL that forwards to hookUrl, on the replay proxy
+    of scope."""
+    schemeless = urlparse(hookUrl)._replace(scheme="").geturl()
+    urlPath = schemeless[2:] if schemeless.startswith("//") else schemeless
+    targetEnv = "dev" if isDevDestination(hookDomain, scope) else "prod"
+    return "{}://{}/{}/path/{}/{}".format(
+        PROTO,
+        getRules()["replayDomains"][scope][targetEnv],
+        prefix,
+        urlparse(hookUrl).scheme,
+        urlPath,
+    )
+
+
+def renameHost(hookUrl):
+    """Return hookUrl with a renamed hostname replaced by its new name."""
+    parsed = urlparse(hookUrl)
+    newHostname = getRules()["oldToNewHostnames"].get(parsed.netloc)
+    if newHostname is None:
+        return hookUrl
+    return parsed._replace(netloc=newHostname).geturl()
+
+
+def rewriteHook(hookUrl):
+    """Decode and rename a hook URL in one go.
+
+    Returns the URL the hook really goes to and its domain, or (None, None)
+    for replay URLs in an unfamiliar format."""
+    decoded = decodeReplayUrl(hookUrl)
+    if decoded is None:
+        return None, None
+    renamed = renameHost(decoded)
+    return renamed, urlparse(renamed).netloc
+
+
+def rewriteHookUrls(hookUrls):
+    """Rewrite a whole list of hook URLs in one pass, into a set."""
+    return {url for url, _ in map(rewriteHook, hookUrls) if url is not None}
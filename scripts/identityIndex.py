@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# identityIndex.py
+#
+# Map GHES logins to their GHEC logins, and know whether those users exist.
+#
+# GHEC logins are {login}_{USER_SUFFIX} unless the overrides file says
+# otherwise. A mapped login only counts if it is a member of the GHEC org, so
+# the scripts can skip unmapped users instead of calling the API for them.
+# The GHES user list and the GHEC org members are fetched when first needed,
+# kept in sets, and saved to the index file so other scripts and reruns can
+# reuse them for IDENTITY_INDEX_TTL seconds. A login that is missing from a
+# saved list fetches that list again once, so users added since are found.
+#
+# Optional Environment Variables
+#     export IDENTITY_INDEX_FILE=<JSON file to save the identity index in>
+#     export IDENTITY_INDEX_TTL=<seconds to trust a saved identity index - a day by default>
+#     export IDENTITY_OVERRIDES_FILE=<JSON file of {"ghes login": "ghec login"} exceptions>
+
+import json
+import os
+import threading
+import time
+
+import utils
+from utils import GHEC_API_URL, GHES_API_URL, USER_SUFFIX
+
+DEFAULT_TTL = int(os.getenv("IDENTITY_INDEX_TTL", str(24 * 60 * 60)))
+
+
+class IdentityIndex:
+    """GHES users and GHEC org members, loaded once and looked up in O(1).
+
+    Org members are fetched the first time an org is asked about, and the
+    GHES user list the first time a login is. The GHES user list is only
+    used when sourceHeaders are given, otherwise any source login is assumed
+    to exist. Lists loaded from the index file are fetched again on a miss,
+    at most once per run."""
+
+    def __init__(
+        self,
+        logger,
+        headers,
+        sourceHeaders=None,
+        indexFile=os.getenv("IDENTITY_INDEX_FILE"),
+        overridesFile=os.getenv("IDENTITY_OVERRIDES_FILE"),
+        ttl=DEFAULT_TTL,
+    ):
+        self.logger = logger
+        self.headers = headers
+        self.sourceHeaders = sourceHeaders
+        self.indexFile = indexFile
+        self.lock = threading.Lock()
+        self.sourceUsers = None
+        self.members: dict = {}
+        # When each list was fetched, to expire them, with the source users
+        # under None
+        self.fetchedAt: dict = {}
+        # The lists fetched during this run, which are not fetched again
+        self.fetched: set = set()
+        self.overrides: dict = {}
+        if indexFile and os.path.exists(indexFile):
+            self.load(indexFile, ttl)
+        if overridesFile:
+            with open(overridesFile, "r") as f:
+                self.overrides = {
+                    login.lower(): cloudLogin
+                    for login, cloudLogin in json.load(f).items()
+                }
+
+    def load(self, indexFile, ttl):
+        with open(indexFile, "r") as f:
+            saved = json.load(f)
+        fetchedAt = saved.get("fetchedAt", {})
+        now = time.time()
+
+        def isFresh(key):
+            return now - fetchedAt.get(key, 0) < ttl
+
+        if saved["sourceUsers"] is not None and isFresh(""):
+            self.sourceUsers = set(saved["sourceUsers"])
+            self.fetchedAt[None] = fetchedAt[""]
+        for org, logins in saved["members"].items():
+            if isFresh(org):
+                self.members[org] = set(logins)
+                self.fetchedAt[org] = fetchedAt[org]
+        self.logger.info(f"Loaded identity index from {indexFile}")
+
+    def fetchSourceUsersLocked(self):
+        url = f"{GHES_API_URL}/users"
+        self.sourceUsers = {
+            user["login"].lower()
+            for user in utils.ghGetPaginated(
+                url, self.sourceHeaders, self.logger, params={"per_page": "100"}
+            )
+        }
+        self.fetchedAt[None] = time.time()
+        self.fetched.add(None)
+        self.logger.info(f"Indexed {len(self.sourceUsers)} GHES users")
+        self.saveLocked()
+
+    def fetchMembersLocked(self, org):
+        url = f"{GHEC_API_URL}/orgs/{org}/members"
+        self.members[org] = {
+            member["login"].lower()
+            for member in utils.ghGetPaginated(
+                url, self.headers, self.logger, params={"per_page": "100"}
+            )
+        }
+        self.fetchedAt[org] = time.time()
+        self.fetched.add(org)
+        self.logger.info(f"Indexed {len(self.members[org])} members of {org}")
+        self.saveLocked()
+
+    def getMembers(self, org):
+        with self.lock:
+            if org not in self.members:
+                self.fetchMembersLocked(org)
+            return self.members[org]
+
+    def isSourceUser(self, login):
+        if not self.sourceHeaders:
+            return True
+        with self.lock:
+            if self.sourceUsers is None or (
+                login not in self.sourceUsers and None not in self.fetched
+            ):
+                self.fetchSourceUsersLocked()
+            return login in self.sourceUsers
+
+    def isMember(self, login, org):
+        with self.lock:
+            if org not in self.members or (
+                login not in self.members[org] and org not in self.fetched
+            ):
+                self.fetchMembersLocked(org)
+            return login in self.members[org]
+
+    def getCloudLogin(self, login, org):
+        """Return the GHEC login of a GHES user if it is a member of org, or
+        None if the user has no account there."""
+        if not self.isSourceUser(login.lower()):
+            return None
+        cloudLogin = self.overrides.get(login.lower(), f"{login}_{USER_SUFFIX}")
+        if cloudLogin and self.isMember(cloudLogin.lower(), org):
+            return cloudLogin
+        return None
+
+    def save(self):
+        with self.lock:
+            self.saveLocked()
+
+    def saveLocked(self):
+        if not self.indexFile:
+            return
+        saved = {
+            "sourceUsers": (
+                sorted(self.sourceUsers) if self.sourceUsers is not None else None
+            ),
+            "members": {org: sorted(logins) for org, logins in self.members.items()},
+            # JSON keys are strings, so the source users are saved under ""
+            "fetchedAt": {
+                "" if key is None else key: fetchedAt
+                for key, fetchedAt in self.fetchedAt.items()
+            },
+        }
+        with open(self.indexFile, "w") as f:
+            json.dump(saved, f, indent=2)
@@ -15,6 +15,7 @@
 
 import logging
 import sys
+from collections import defaultdict
 from time import sleep
 
 import requests
@@ -38,132 +39,130 @@ headers = utils.ghHeaders(token)
 sourceHeaders = {
     "Authorization": f"token {sourceToken}",
 }
-cache = {}
+# Installations by (apiUrl, org), slug -> installation id by GHEC org, and
+# repo name -> selected installations by GHES org
+installationCache: dict = {}
+slugIndex: dict = {}
+repoInstallIndex: dict = {}
 
 
 def getInstalledApps(org, headers=sourceHeaders, apiUrl=utils.GHES_API_URL):
-    utils.ghRateLimitSleep(sourceToken, logger)
-    url = "{}/orgs/{}/installations".format(apiUrl, org)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-    logger.info("Retrieving installed apps in org {} for {}".format(org, apiUrl))
-
-    if res.status_code == 200:
-        apps = res.json()["installations"]
-        while "next" in res.links.keys():
-            utils.ghRateLimitSleep(sourceToken, logger)
-            res = requests.get(
-                res.links["next"]["url"], headers=headers, timeout=DEFAULT_TIMEOUT
+    """Return the app installations of an org, fetching them once."""
+    if (apiUrl, org) not in installationCache:
+        utils.ghRateLimitSleep(sourceToken, logger)
+        logger.info("Retrieving installed apps in org {} for {}".format(org, apiUrl))
+        url = "{}/orgs/{}/installations".format(apiUrl, org)
+        installationCache[(apiUrl, org)] = list(
+            utils.ghGetPaginated(
+                url, headers, logger, params={"per_page": "100"}, key="installations"
             )
-            apps.extend(res.json()["installations"])
-        return apps
-    elif res.status_code == 404:
-        logger.info("No app found in {}".format(url))
-        return {}
-    else:
-        err = "Got {} error from {}, message: {}".format(
-            res.status_code, url, res.json()
         )
-        logger.error(err)
-        raise Exception(err)
+    return installationCache[(apiUrl, org)]
 
 
 def getInstalledAppRepos(installId, headers=sourceHeaders, apiUrl=utils.GHES_API_URL):
-    url = "{}/user/installations/{}/repositories?per_page=100".format(apiUrl, installId)
+    url = "{}/user/installations/{}/repositories".format(apiUrl, installId)
     logger.debug("fetching repos for app with id {}".format(installId))
     utils.ghRateLimitSleep(sourceToken, logger)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-
-    if res.status_code == 200:
-        repos = res.json()["repositories"]
-        while "next" in res.links.keys():
-            utils.ghRateLimitSleep(sourceToken, logger)
-            res = requests.get(
-                res.links["next"]["url"], headers=headers, timeout=DEFAULT_TIMEOUT
-            )
-            repos.extend(res.json()["repositories"])
-        return repos
-    elif res.status_code == 404:
-        logger.info("No app found in {}".format(url))
-        return {}
-    else:
-        err = "Got {} error from {}, message: {}".format(
-            res.status_code, url, res.json()
+    return list(
+        utils.ghGetPaginated(
+            url, headers, logger, params={"per_page": "100"}, key="repositories"
         )
-        logger.error(err)
-        raise Exception(err)
+    )
+
+
+def getGhecInstallIds(org):
+    """Return the installation ids of a GHEC org by app slug."""
+    if org not in slugIndex:
+        slugIndex[org] = {
+            app["app_slug"]: app["id"]
+            for app in getInstalledApps(org, headers=headers, apiUrl=utils.GHEC_API_URL)
+        }
+    return slugIndex[org]
+
+
+def getRepoInstalls(org):
+    """Return the GHES installations limited to selected repos, by repo name.
+
+    The repos of every installation are listed once per org, and inverted so
+    finding the apps of a repo is a dict lookup."""
+    if org not in repoInstallIndex:
+        index: dict = defaultdict(list)
+        for app in getInstalledApps(
+            org, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
+        ):
+            if app["repository_selection"] == "all":
+                logger.warning(
+                    "Skipping app named {} in GHES org {} as it is enabled for all repos, ensure this is done in GHEC".format(
+                        app["app_slug"], org
+                    )
+                )
+                continue
+            for appRepo in getInstalledAppRepos(
+                app["id"], headers=sourceHeaders, apiUrl=utils.GHES_API_URL
+            ):
+                index[appRepo["name"].lower()].append(app)
+        repoInstallIndex[org] = index
+    return repoInstallIndex[org]
 
 
 def addRepoToInstalledApp(
-    appId, repo, org, appName, ghecApps, headers=headers, apiUrl=utils.GHEC_API_URL
+    repo,
+    repoid,
+    org,
+    appName,
+    ghecInstallIds,
+    headers=headers,
+    apiUrl=utils.GHEC_API_URL,
 ):
-    installId = ""
     appSlug = (
         utils.GHES_TO_GHEC_APP_NAME_MATCH[appName]
         if utils.GHES_TO_GHEC_APP_NAME_MATCH.get(appName) is not None
         else appName
     )
-    for app in ghecApps:
-        if appSlug == app["app_slug"]:
-            installId = app["id"]
-            break
-    if installId == "":
+    installId = ghecInstallIds.get(appSlug)
+    if installId is None:
         sys.exit(
             "App named {} with slug {} not found in github cloud org {}, skipping".format(
                 appName, appSlug, org
             )
         )
 
-    if appId not in cache:
-        cache[appId] = getInstalledAppRepos(
-            appId, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-        )
-    for appRepo in cache[appId]:
-        if appRepo["name"] == repo:
-            repoDetails = utils.getRepoDetails(logger, org, repo, headers, apiUrl)
-            repoid = repoDetails["id"]
-            url = "{}/user/installations/{}/repositories/{}".format(
-                apiUrl, installId, repoid
-            )
-            logger.info("Adding repo {} to app {}".format(repo, appName))
-            sleep(1)
-            utils.ghRateLimitSleep(token, logger, instance="github.com")
-            requests.put(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-            break
+    url = "{}/user/installations/{}/repositories/{}".format(apiUrl, installId, repoid)
+    logger.info("Adding repo {} to app {}".format(repo, appName))
+    sleep(1)
+    utils.ghRateLimitSleep(token, logger, instance="github.com")
+    requests.put(url, headers=headers, timeout=DEFAULT_TIMEOUT)
 
 
 # BEGIN main logic of script
+repoPairs = [
+    utils.getOrgAndRepoPairs(line) for line in sys.stdin if not COMMENT_RE.match(line)
+]
+# Resolve the ids of every destination repo up front, in batches
+utils.ghRateLimitSleep(token, logger, instance="github.com")
+repoIds = utils.getRepoIds(
+    [(destOrg, destRepo) for _, _, destOrg, destRepo in repoPairs], token, logger
+)
 
-for line in sys.stdin:
-    if COMMENT_RE.match(line):
-        continue
-    (sourceOrg, sourceRepo, destOrg, destRepo) = utils.getOrgAndRepoPairs(line)
-    repoDetails = utils.getRepoDetails(
-        logger, destOrg, destRepo, headers=headers, apiUrl=utils.GHEC_API_URL
-    )
-    archived = repoDetails["archived"]
-    if archived:
-        logger.warning("Skipping {} as it is archived".format(line))
+for sourceOrg, sourceRepo, destOrg, destRepo in repoPairs:
+    repoDetails = repoIds[(destOrg, destRepo)]
+    if repoDetails is None:
+        logger.error("No repo found at {}/{}".format(destOrg, destRepo))
+        sys.exit(1)
+    if repoDetails["isArchived"]:
+        logger.warning("Skipping {}/{} as it is archived".format(destOrg, destRepo))
         continue
 
-    ghesApps = getInstalledApps(
-        sourceOrg, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-    )
-    ghecApps = getInstalledApps(destOrg, headers=headers, apiUrl=utils.GHEC_API_URL)
-    for app in ghesApps:
-        if app["repository_selection"] == "all":
-            logger.warning(
-                "Skipping adding repo {} to app named {} in GHES as it is enabled for all repos, ensure this is done in GHEC".format(
-                    destRepo, app["app_slug"]
-                )
-            )
-            continue
+    ghecInstallIds = getGhecInstallIds(destOrg)
+    for app in getRepoInstalls(sourceOrg).get(sourceRepo.lower(), []):
         try:
             addRepoToInstalledApp(
-                app["id"],
                 destRepo,
+                repoDetails["databaseId"],
                 destOrg,
                 app["app_slug"],
-                ghecApps,
+                ghecInstallIds,
                 headers=headers,
                 apiUrl=utils.GHEC_API_URL,
             )
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 # migrateOrgHooks.py
+#
+# Migrate the hooks of every org on GitHub Enterprise Server to its
+# {GHEC_PREFIX}-{org} counterpart on GitHub Enterprise Cloud, several orgs at
+# a time. Hooks that already exist in the destination org are skipped, so it
+# is safe to run again.
 
-import ipaddress
 import json
-import socket
+import os
 import sys
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import dnsResolver
+import hookRules
 import requests
 import utils
 from utils import DEFAULT_TIMEOUT, GHEC_API_URL, GHEC_PREFIX
@@ -16,6 +22,10 @@ from utils import DEFAULT_TIMEOUT, GHEC_API_URL, GHEC_PREFIX
 export GH_PAT=<The Personal Access Token from GHEC>
 export VAULT_TOKEN=<The Vault Token from vault.example.com>
 export GH_SOURCE_PAT=<The Personal Access Token from GHES>
+
+# Optional Environment Variables
+export ORG_CONCURRENCY=<how many orgs to migrate at once - 4 by default>
+export HOOK_RULES_FILE=<JSON file with the hook URL rewrite rules - data/hookRules.json by default>
 """
 
 logger = utils.getLogger()
@@ -26,123 +36,135 @@ sourceToken = utils.assertGetenv(
     "GH_SOURCE_PAT", "Provide a GitHub Enterprise Server personal access token"
 )
 vaultToken = utils.assertGetenv("VAULT_TOKEN", "Provide a Vault token")
+orgConcurrency = int(os.getenv("ORG_CONCURRENCY", "4"))
 
 
-REPLAY_DOMAINS = {
-    "dev": "replay-dev.example.com",
-    # Prod is now a real value
-    "prod": "replay.app.example.com",
-}
-
-# Require HTTPS for webhook destinations
-PROTO = "https"
-
-# TODO put in list of real prod domains to differentiate.
-# Consider reading it in from a text file instead of hardcoding it here.
-DEV_HOOK_DESTINATIONS = ["somedomain.subdomain.example.com"]
-# Secret lengths for HMAC secrets we generate
-
 headers = {
     "Authorization": f"token {token}",
 }
 sourceHeaders = {
     "Authorization": f"token {sourceToken}",
 }
-vaultHeaders = {"X-VAULT-TOKEN": f"{vaultToken}"}
-vaultUri = "https://vault.example.com:8200/v1/secret/data"
-
-orgUrl = "{}/organizations".format(utils.GHEC_API_URL)
-
-res = requests.get(orgUrl, headers=sourceHeaders, timeout=DEFAULT_TIMEOUT)
-if res.status_code == 200:
-    orgs = res.json()
-elif res.status_code == 404:
-    logger.warning("No orgs found in {}".format(orgUrl))
-else:
-    logger.error("Error: {} {}".format(res.status_code, res.text))
-    sys.exit(1)
-orgList = []
-orgList.append(orgs)
-orgListing = []
-for sub in orgList:
-    for newsub in sub:
-        orgListing.append(newsub["login"])
-
-for org in orgListing:  # noqa: C901
-    ghesurl = "{}/orgs/{}/hooks".format(utils.GHEC_API_URL, org)
-    res = requests.get(ghesurl, headers=sourceHeaders, timeout=DEFAULT_TIMEOUT)
-    if res.status_code != 200:
-        logger.error(
-            "Error retrieving orgs from GHES: {} {}".format(res.status_code, res.text)
-        )
-        sys.exit(1)
-    hooks = res.json()
-    for hook in hooks:
-        hookContentType = hook["config"]["content_type"]
-        hookUrl = hook["config"]["url"]
-        # TODO: You can swap hook urls here if needed
-        hookName = hook["name"]
-        hookActive = hook["active"]
-        hookEvents = hook["events"]
-        hookUrlParsed = urlparse(hookUrl)
-        origHookDomain = hookUrlParsed.netloc
-        if origHookDomain in DEV_HOOK_DESTINATIONS:
-            namespace = "dev"
-        else:
-            namespace = "prod"
-
-        if origHookDomain in REPLAY_DOMAINS.values():
-            hookUrlList = hookUrl.split("/", -1)
-            if hookUrlList[4] == "path":
-                hookUrl = "{}://{}".format(hookUrlList[5], "/".join(hookUrlList[6:]))
-                hookDomain = urlparse(hookUrl).netloc
-            else:
-                logger.warning(
-                    "the hook url {} isnt in a familiar format, skipping this hook".format(
-                        hookUrl
-                    )
-                )
-                continue
-        else:
-            hookDomain = origHookDomain
-
-        urlPath, urlScheme = utils.edit_scheme(hookUrl)
-        destHookUrl = f"{PROTO}://{REPLAY_DOMAINS[namespace]}/reverse_proxy/path/{urlScheme}/{urlPath}"
+vaultClient = utils.getVaultClient(vaultToken)
+# Org hook secrets live in their own mount points
+VAULT_MOUNTPOINTS = ["department/{}/kv/secrets".format(ns) for ns in ["prod", "dev"]]
 
-        try:
-            ip = socket.gethostbyname(hookDomain)
-            isIpPrivate = ipaddress.ip_address(ip).is_private
-        except socket.gaierror as err:
-            isIpPrivate = True
-            logger.info(
-                "IP of {} is not resolvable, assigning as Private. Resolver message: {}".format(
-                    hookDomain, err
-                )
-            )
-        hookDomainVault = hookDomain.replace(".", "_").upper()
-        vaultPath = "reverse-proxy/EXAMPLE_SECRET_{}".format(hookDomainVault)
-        mount_point = "department/{}/kv/secrets".format(namespace)
-        if isIpPrivate:
-            hmacSecret = utils.readOrCreateVaultSecret(
-                logger, vaultUri, vaultHeaders, vaultPath, mount_point
+
+def getOrgHooks(org, headers, apiUrl):
+    url = "{}/orgs/{}/hooks".format(apiUrl, org)
+    return list(utils.ghGetPaginated(url, headers, logger, params={"per_page": "100"}))
+
+
+def getOrgHookSecret(hookDomain, namespace):
+    if not utils.isIpPrivate(hookDomain, logger):
+        return ""
+    hookDomainVault = hookDomain.replace(".", "_").upper()
+    vaultPath = "reverse-proxy/EXAMPLE_SECRET_{}".format(hookDomainVault)
+    mount_point = "department/{}/kv/secrets".format(namespace)
+    return utils.readOrCreateVaultSecretCached(
+        logger, vaultClient, vaultPath, mount_point
+    )
+
+
+def createOrgHook(org, destOrg, hook, existingUrls):
+    """Create the destination copy of an org hook, unless it already exists.
+
+    Returns True if a hook was created."""
+    hookUrl, hookDomain = hookRules.rewriteHook(hook["config"]["url"])
+    # TODO: You can swap hook urls here if needed
+    if hookUrl is None:
+        logger.warning(
+            "the hook url {} isnt in a familiar format, skipping this hook".format(
+                hook["config"]["url"]
             )
-        else:
-            hmacSecret = ""
-        logger.info("migrating hook: {} in org {}".format(hookUrl, org))
-        payload = {
-            "name": hookName,
-            "active": hookActive,
-            "events": hookEvents,
-            "config": {
-                "content_type": hookContentType,
-                "insecure_ssl": "0",
-                "url": destHookUrl,
-                "secret": hmacSecret,
-            },
-        }
-        requests.post(
-            f"{GHEC_API_URL}/orgs/{GHEC_PREFIX}-{org}/hooks",
-            json.dumps(payload),
-            headers=headers,
-            timeout=DEFAULT_TIMEOUT,
         )
+        return False
+    if hookRules.isDevDestination(hookDomain, hookRules.ORG_HOOKS):
+        namespace = "dev"
+    else:
+        namespace = "prod"
+
+    destHookUrl = hookRules.encodeReplayUrl(
+        hookUrl, hookDomain, prefix="reverse_proxy", scope=hookRules.ORG_HOOKS
+    )
+    # Existing hooks are compared by where they forward to, so they match
+    # whichever replay proxy they were created on
+    if hookUrl in existingUrls:
+        logger.info("hook {} already exists in org {}".format(hookUrl, destOrg))
+        return False
+
+    logger.info("migrating hook: {} in org {}".format(hookUrl, org))
+    payload = {
+        "name": hook["name"],
+        "active": hook["active"],
+        "events": hook["events"],
+        "config": {
+            "content_type": hook["config"]["content_type"],
+            "insecure_ssl": "0",
+            "url": destHookUrl,
+            "secret": getOrgHookSecret(hookDomain, namespace),
+        },
+    }
+    res = requests.post(
+        f"{GHEC_API_URL}/orgs/{destOrg}/hooks",
+        json.dumps(payload),
+        headers=headers,
+        timeout=DEFAULT_TIMEOUT,
+    )
+    if res.status_code != 201:
+        message = f"Got {res.status_code} creating hook {destHookUrl} in org {destOrg}, message: {res.json()}"
+        raise utils.UnexpectedStateError(message)
+    existingUrls.add(hookUrl)
+    return True
+
+
+def migrateOrgHooks(org):
+    """Migrate the hooks of one org, returning how many were created."""
+    destOrg = f"{GHEC_PREFIX}-{org}"
+    hooks = getOrgHooks(org, sourceHeaders, utils.GHES_API_URL)
+    existingUrls = hookRules.rewriteHookUrls(
+        hook["config"]["url"] for hook in getOrgHooks(destOrg, headers, GHEC_API_URL)
+    )
+    # Resolve every hook domain of the org at once
+    dnsResolver.resolveDomains(
+        {
+            hookDomain
+            for _, hookDomain in map(
+                hookRules.rewriteHook, (hook["config"]["url"] for hook in hooks)
+            )
+            if hookDomain is not None
+        },
+        logger,
+    )
+    utils.ghRateLimitSleep(token, logger, instance="github.com")
+    return sum(createOrgHook(org, destOrg, hook, existingUrls) for hook in hooks)
+
+
+# BEGIN main logic of script
+utils.prefetchVaultSecrets(logger, vaultClient, mountPoints=VAULT_MOUNTPOINTS)
+
+orgUrl = "{}/organizations".format(utils.GHES_API_URL)
+orgListing = [
+    org["login"]
+    for org in utils.ghGetPaginated(
+        orgUrl, sourceHeaders, logger, params={"per_page": "100"}
+    )
+]
+logger.info(
+    "Migrating the hooks of {} orgs, {} at a time".format(
+        len(orgListing), orgConcurrency
+    )
+)
+
+failed = False
+with ThreadPoolExecutor(max_workers=orgConcurrency) as executor:
+    futures = {executor.submit(migrateOrgHooks, org): org for org in orgListing}
+    for future in as_completed(futures):
+        org = futures[future]
+        try:
+            logger.info("Created {} hooks for org {}".format(future.result(), org))
+        except Exception as e:
+            logger.error("Could not migrate the hooks of org {}: {}".format(org, e))
+            failed = True
+if failed:
+    sys.exit(1)
@@ -17,11 +17,13 @@
 #     scripts/migratePermissions.py < data/repoListPairs.txt
 
 import json
+import os
 import sys
 
+import identityIndex
 import requests
 import utils
-from utils import COMMENT_RE, DEFAULT_TIMEOUT, USER_SUFFIX
+from utils import COMMENT_RE, DEFAULT_TIMEOUT
 
 """
 # Required Environment Variables
@@ -30,6 +32,11 @@ export GH_SOURCE_PAT=<The Personal Access Token from GHES>
 
 # Optional Environment Variables
 export GH_ORG=<GHEC org name>
+export IDENTITY_INDEX_FILE=<JSON file to save the identity index in>
+export IDENTITY_INDEX_TTL=<seconds to trust a saved identity index - a day by default>
+export IDENTITY_OVERRIDES_FILE=<JSON file of {"ghes login": "ghec login"} exceptions>
+export TEAM_INDEX_DIR=<directory of team indexes from buildTeamIndex.py, built if missing>
+export PERMISSION_WRITES_PER_MINUTE=<how many permission writes to send per minute - 60 by default>
 """
 
 logger = utils.getLogger()
@@ -47,31 +54,88 @@ sourceHeaders = {
     "Authorization": f"token {sourceToken}",
 }
 
+PERMISSIONS = ["admin", "maintain", "push", "triage", "pull"]
+# Invitations name permissions differently from collaborators
+INVITATION_PERMISSIONS = {"read": "pull", "write": "push"}
 
-def getRepoCollaborators(url, headers=sourceHeaders):
-    utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-    if res.status_code == 200:
-        collabs = res.json()
-        while "next" in res.links.keys():
-            res = requests.get(
-                res.links["next"]["url"], headers=headers, timeout=DEFAULT_TIMEOUT
+# Permission writes are paced instead of probing /rate_limit before each one
+writesPerMinute = int(os.getenv("PERMISSION_WRITES_PER_MINUTE", "60"))
+writeBucket = utils.TokenBucket(writesPerMinute / 60)
+
+identities = identityIndex.IdentityIndex(logger, headers, sourceHeaders)
+
+teamIndexDir = os.getenv("TEAM_INDEX_DIR")
+teamIndexes: dict = {}
+
+
+def getRepoCollaborators(
+    url, headers=sourceHeaders, authToken=sourceToken, instance="github.example.com"
+):
+    utils.ghRateLimitSleep(authToken, logger, instance=instance, threshold=120)
+    return list(utils.ghGetPaginated(url, headers, logger, params={"per_page": "100"}))
+
+
+def getTeamCollaborators(sourceOrg, sourceRepo):
+    """Return the teams of a source repo, from the org's team index if
+    TEAM_INDEX_DIR is set, or else from the repo itself."""
+    if not teamIndexDir:
+        url = "{}/repos/{}/{}/teams".format(utils.GHES_API_URL, sourceOrg, sourceRepo)
+        return getRepoCollaborators(url, headers=sourceHeaders)
+    if sourceOrg not in teamIndexes:
+        index = utils.readTeamRepoIndex(teamIndexDir, sourceOrg)
+        if index is None:
+            utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+            index = utils.buildTeamRepoIndex(sourceOrg, sourceHeaders, logger)
+            utils.writeTeamRepoIndex(teamIndexDir, sourceOrg, index)
+        teamIndexes[sourceOrg] = index
+    return teamIndexes[sourceOrg].get(sourceRepo.lower(), [])
+
+
+def getPermission(collab):
+    """Return the highest permission a user or team has on a repo."""
+    for perm in PERMISSIONS:
+        if collab["permissions"][perm]:
+            return perm
+    return None
+
+
+def getDestPermissions(destOrg, destRepo):
+    """Return the current user and team permissions of a destination repo.
+
+    Users with a pending invitation count as collaborators, so they are not
+    invited again."""
+    apiUrl = "{}/repos/{}/{}".format(utils.GHEC_API_URL, destOrg, destRepo)
+    users = {
+        collab["login"].lower(): getPermission(collab)
+        for collab in getRepoCollaborators(
+            f"{apiUrl}/collaborators?affiliation=direct",
+            headers=headers,
+            authToken=token,
+            instance="github.com",
+        )
+    }
+    for invitation in getRepoCollaborators(
+        f"{apiUrl}/invitations", headers=headers, authToken=token, instance="github.com"
+    ):
+        if invitation["invitee"]:
+            users.setdefault(
+                invitation["invitee"]["login"].lower(),
+                INVITATION_PERMISSIONS.get(
+                    invitation["permissions"], invitation["permissions"]
+                ),
             )
-            collabs.extend(res.json())
-        return collabs
-    elif res.status_code == 404:
-        logger.info("No collaborators found in {}".format(url))
-        return {}
-    else:
-        logger.error(
-            "Got {} error from {}, message: {}".format(res.status_code, url, res.json())
+    teams = {
+        team["slug"]: getPermission(team)
+        for team in getRepoCollaborators(
+            f"{apiUrl}/teams", headers=headers, authToken=token, instance="github.com"
         )
-        sys.exit(1)
+    }
+    return users, teams
 
 
 def putRepoCollabs(url, collabPermission, headers=headers):
     payload = {"permission": collabPermission}
-    utils.ghRateLimitSleep(token, logger, instance="github.com")
+    writeBucket.acquire()
     res = requests.put(
         url, json.dumps(payload), headers=headers, timeout=DEFAULT_TIMEOUT
     )
@@ -85,10 +149,12 @@ def putRepoCollabs(url, collabPermission, headers=headers):
         )
         return {}
     elif (
-        res.status_code == 403 and res.json().message == "Repository has been locked"
+        res.status_code == 403
+        and res.json().get("message") == "Repository has been locked"
     ) or (
         res.status_code == 422
-        and res.json().message == "This repository is locked and cannot be modified"
+        and res.json().get("message")
+        == "This repository is locked and cannot be modified"
     ):
         logger.warning(
             "Repository locked - got {} from {}: {}".format(
@@ -127,34 +193,49 @@ for line in sys.stdin:  # noqa: C901
     )
     userCollabs = getRepoCollaborators(url, headers=sourceHeaders)
     # Get Team collaborators
-    url = "{}/repos/{}/{}/teams".format(utils.GHES_API_URL, sourceOrg, sourceRepo)
-    teamCollabs = getRepoCollaborators(url, headers=sourceHeaders)
+    teamCollabs = getTeamCollaborators(sourceOrg, sourceRepo)
+    # Only write the permissions the destination does not have yet
+    destUsers, destTeams = getDestPermissions(destOrg, destRepo)
+    utils.ghRateLimitSleep(token, logger, instance="github.com")
 
     for collab in userCollabs:
-        collabLogin = collab["login"]
-        permissions = ["admin", "maintain", "push", "triage", "pull"]
-        for perm in permissions:
-            if collab["permissions"][perm]:
-                collabPermission = perm
-                break
+        collabLogin = identities.getCloudLogin(collab["login"], destOrg)
+        collabPermission = getPermission(collab)
+        if not collabLogin:
+            logger.warning(
+                "Skipping user collaborator {} of repo {}, who has no account in {}".format(
+                    collab["login"], sourceRepo, destOrg
+                )
+            )
+            continue
+        if destUsers.get(collabLogin.lower()) == collabPermission:
+            logger.debug(
+                "user collaborator {} already has {} permissions for repo {}".format(
+                    collabLogin, collabPermission, destRepo
+                )
+            )
+            continue
         logger.debug(
             "processing permission for user collaborator {} with {} permissions for repo {}".format(
                 collabLogin, collabPermission, sourceRepo
             )
         )
-        url = "{}/repos/{}/{}/collaborators/{}_{}".format(
-            utils.GHEC_API_URL, destOrg, destRepo, collabLogin, USER_SUFFIX
+        url = "{}/repos/{}/{}/collaborators/{}".format(
+            utils.GHEC_API_URL, destOrg, destRepo, collabLogin
         )
         putRepoCollabs(url, collabPermission)
     for collab in teamCollabs:
+        collabPermission = getPermission(collab)
+        if destTeams.get(collab["slug"]) == collabPermission:
+            logger.debug(
+                "team collaborator {} already has {} permissions for repo {}".format(
+                    collab["slug"], collabPermission, destRepo
+                )
+            )
+            continue
         url = "{}/orgs/{}/teams/{}/repos/{}/{}".format(
             utils.GHEC_API_URL, destOrg, collab["slug"], destOrg, destRepo
         )
-        permissions = ["admin", "maintain", "push", "triage", "pull"]
-        for perm in permissions:
-            if collab["permissions"][perm]:
-                collabPermission = perm
-                break
         logger.debug(
             "processing permission for team collaborator {} with {} permissions for repo {}".format(
                 collab["slug"], collabPermission, sourceRepo
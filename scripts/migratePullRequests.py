@@ -23,11 +23,16 @@
 import json
 import os
 import sys
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 from time import sleep
 
+import identityIndex
 import requests
 import utils
-from utils import COMMENT_RE, DEFAULT_TIMEOUT, USER_SUFFIX, UnexpectedStateError
+from utils import COMMENT_RE, DEFAULT_TIMEOUT, UnexpectedStateError
 
 """
 # Required Environment Variables
@@ -36,6 +41,15 @@ export GH_SOURCE_PAT=<The Personal Access Token from GHES>
 export DRY_RUN=<true or false - only really create PRs if true>
 # Optional Environment Variables
 export CHECK_CLOSED_PRS=<true or false - false by default>
+export BATCH_REVIEW_COMMENTS=<true or false - post review comments as one review, false by default>
+export CLOSED_PR_MODE=<gitdata, commit or issue - how to recreate closed PRs, gitdata by default>
+export COMMENTS_SINCE=<ISO 8601 timestamp - only migrate comments updated after this>
+export READ_AHEAD=<how many PRs to prefetch from the source, at least 1 - 5 by default>
+export REPO_CONCURRENCY=<how many repos to migrate at once - 1 by default>
+export MUTATIONS_PER_MINUTE=<write budget shared by all repos, at most 80 - 12 by default>
+export IDENTITY_INDEX_FILE=<JSON file to save the identity index in>
+export IDENTITY_INDEX_TTL=<seconds to trust a saved identity index - a day by default>
+export IDENTITY_OVERRIDES_FILE=<JSON file of {"ghes login": "ghec login"} exceptions>
 export LOG_LEVEL=DEBUG
 """
 
@@ -44,6 +58,7 @@ sourceToken = utils.assertGetenv(
     "GH_SOURCE_PAT", "Provide a GitHub Enterprise Server personal access token"
 )
 prNumCreated = 0
+prNumCreatedLock = threading.Lock()
 
 headers = utils.ghHeaders(token)
 sourceHeaders = utils.ghHeaders(sourceToken)
@@ -52,13 +67,45 @@ exitCode = 0
 
 dryRun = True if os.getenv("DRY_RUN", "false") == "true" else False
 checkClosedPrs = True if os.getenv("CHECK_CLOSED_PRS", "false") == "true" else False
+batchReviewComments = (
+    True if os.getenv("BATCH_REVIEW_COMMENTS", "false") == "true" else False
+)
+closedPrMode = utils.getenvChoice("CLOSED_PR_MODE", utils.CLOSED_PR_MODES, "gitdata")
+commentsSince = os.getenv("COMMENTS_SINCE")
+readAhead = max(1, int(os.getenv("READ_AHEAD", "5")))
+repoConcurrency = int(os.getenv("REPO_CONCURRENCY", "1"))
+mutationsPerMinute = min(
+    int(os.getenv("MUTATIONS_PER_MINUTE", "12")), utils.GHEC_CONTENT_CREATION_PER_MINUTE
+)
 logLevel = os.getenv("LOG_LEVEL", "INFO")
 
 logger = utils.getLogger(logLevel)
 
+# One budget for all the repos being migrated at once, as they share a token
+# and so GitHub's secondary rate limit for content creation
+mutationBucket = utils.TokenBucket(mutationsPerMinute / 60)
+
+identities = identityIndex.IdentityIndex(logger, headers, sourceHeaders)
+
+
+PLACEHOLDER_FILE = "placeholder-migratePullRequests.md"
+PLACEHOLDER_CONTENT = """This is a _dummy commit_ constructed by
+[migratePullRequests.py](https://github.com/example-org/github-migration/blob/main/scripts/migratePullRequests.py).
+
+*Please see the original pull request linked from this pull request for a full history.*"""
+
 
 def longSleep():
-    sleep(5)
+    # Mutations from every repo being migrated share one budget
+    mutationBucket.acquire()
+
+
+def countCreated():
+    """Count a created PR or issue as soon as it exists, so the total is
+    right even if its repo fails later."""
+    global prNumCreated
+    with prNumCreatedLock:
+        prNumCreated += 1
 
 
 def getRepoPrDetails(
@@ -95,20 +142,25 @@ def getRepoIssuesDetails(
         raise UnexpectedStateError(message)
 
 
-def getRepoPrComments(url, headers=sourceHeaders):
-    sleep(1)
-    res = requests.get(
-        url, headers=headers, params={"per_page": "100"}, timeout=DEFAULT_TIMEOUT
+def getRepoCommentIndex(
+    org, repo, kind, since=None, apiUrl=utils.GHES_API_URL, headers=sourceHeaders
+):
+    """Fetch every issue or review comment in a repository, grouped by number.
+
+    kind is "issues" or "pulls". This pages through the repository-wide
+    comment listing once instead of asking for the comments of each PR."""
+    url = f"{apiUrl}/repos/{org}/{repo}/{kind}/comments"
+    params = {"per_page": "100", "sort": "created", "direction": "asc"}
+    if since:
+        params["since"] = since
+    numberKey = "issue_url" if kind == "issues" else "pull_request_url"
+    index = defaultdict(list)
+    for comment in utils.ghGetPaginated(url, headers, logger, params=params):
+        index[int(comment[numberKey].rsplit("/", 1)[1])].append(comment)
+    logger.info(
+        f"Found {kind} comments for {len(index)} numbers in {org}/{repo} since {since}"
     )
-    if res.status_code == 200:
-        comments = res.json()
-        return comments
-    elif res.status_code == 404:
-        logger.info(f"No pr found in {url}")
-        return {}
-    else:
-        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
-        raise UnexpectedStateError(message)
+    return index
 
 
 def createPrOrIssue(url, body, num, headers=headers):
@@ -130,30 +182,14 @@ def createPrOrIssue(url, body, num, headers=headers):
         raise UnexpectedStateError(message)
 
 
-def checkBranch(branch, org, repo, apiUrl=utils.GHEC_API_URL):
-    url = f"{apiUrl}/repos/{org}/{repo}/branches/{branch}"
-    message = f"Checking branch {url}"
-    logger.debug(message)
-    sleep(1)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-    logger.debug(res)
-    if res.status_code == 200:
-        return True
-    else:
-        return False
-
-
-def checkPrNum(prNum, org, repo, apiUrl=utils.GHEC_API_URL):
-    url = f"{apiUrl}/repos/{org}/{repo}/pulls/{prNum}"
-    sleep(1)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-    if res.status_code == 200:
-        return True
-    else:
-        return False
+def checkNumber(newNumber, expected):
+    """Stop before anything else is created with shifted numbers."""
+    if newNumber != expected:
+        message = f"New PR or issue number {newNumber} does not match expected PR {expected} - this is introduced an anomaly."
+        raise UnexpectedStateError(message)
 
 
-def createBranch(branch, sha, org, repo, apiUrl=utils.GHEC_API_URL):
+def createBranch(branch, sha, org, repo, branches, apiUrl=utils.GHEC_API_URL):
     message = f"Creating branch {branch} for {org}/{repo} at {sha}"
     logger.info(message)
     if dryRun:
@@ -162,18 +198,119 @@ def createBranch(branch, sha, org, repo, apiUrl=utils.GHEC_API_URL):
     url = f"{apiUrl}/repos/{org}/{repo}/git/refs".format(apiUrl, org, repo)
     body = {"ref": f"refs/heads/{branch}", "sha": f"{sha}"}
     longSleep()
-    requests.post(url, json.dumps(body), headers=headers, timeout=DEFAULT_TIMEOUT)
+    res = requests.post(url, json.dumps(body), headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code != 201:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+    branches.add(branch)
 
 
-def delBranch(branch, org, repo, apiUrl=utils.GHEC_API_URL):
+def delBranch(branch, org, repo, branches, apiUrl=utils.GHEC_API_URL):
     message = f"Deleting branch {branch} for {org}/{repo} using {apiUrl}"
     logger.info(message)
     if dryRun:
         logger.info(f"Dry run - {message}")
         return
-    url = f"{apiUrl}/repos/{org}/{repo}/git/refs/{branch}"
+    url = f"{apiUrl}/repos/{org}/{repo}/git/refs/heads/{branch}"
     longSleep()
-    requests.delete(url, headers=headers, timeout=DEFAULT_TIMEOUT)
+    res = requests.delete(url, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code != 204:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+    branches.discard(branch)
+
+
+def createGitObject(org, repo, kind, body, apiUrl=utils.GHEC_API_URL):
+    url = f"{apiUrl}/repos/{org}/{repo}/git/{kind}"
+    logger.info(f"Creating git object {url}")
+    longSleep()
+    res = requests.post(url, json.dumps(body), headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code == 201:
+        return res.json()["sha"]
+    else:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+
+
+def getPlaceholderCommit(baseSha, org, repo, placeholders, apiUrl=utils.GHEC_API_URL):
+    """Return a placeholder commit on top of baseSha for closed PR branches.
+
+    The placeholder blob is created once per repo, and the tree and commit
+    once per base commit, using the Git Data API. Every closed PR sharing a
+    base commit points its branch at the same placeholder commit."""
+    commits = placeholders["commits"]
+    if baseSha in commits:
+        return commits[baseSha]
+    message = f"Creating placeholder commit for {org}/{repo} on top of {baseSha}"
+    logger.info(message)
+    if dryRun:
+        logger.info(f"Dry run - {message}")
+        return baseSha
+    if placeholders["blob"] is None:
+        placeholders["blob"] = createGitObject(
+            org,
+            repo,
+            "blobs",
+            {"content": PLACEHOLDER_CONTENT, "encoding": "utf-8"},
+            apiUrl=apiUrl,
+        )
+    url = f"{apiUrl}/repos/{org}/{repo}/git/commits/{baseSha}"
+    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code != 200:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+    treeSha = createGitObject(
+        org,
+        repo,
+        "trees",
+        {
+            "base_tree": res.json()["tree"]["sha"],
+            "tree": [
+                {
+                    "path": PLACEHOLDER_FILE,
+                    "mode": "100644",
+                    "type": "blob",
+                    "sha": placeholders["blob"],
+                }
+            ],
+        },
+        apiUrl=apiUrl,
+    )
+    commits[baseSha] = createGitObject(
+        org,
+        repo,
+        "commits",
+        {
+            "message": "Dummy commit from migratePullRequests.py for GHCM-32",
+            "tree": treeSha,
+            "parents": [baseSha],
+        },
+        apiUrl=apiUrl,
+    )
+    return commits[baseSha]
+
+
+def checkOpenPrBranches(sourceOrg, sourceRepo, destOrg, destRepo, prNums, branches):
+    """Fail before any writes if an open source PR has no branch on the destination."""
+    headRefs = utils.getOpenPrHeadRefs(
+        sourceOrg,
+        sourceRepo,
+        sourceToken,
+        logger,
+        "https://github.example.com/api/graphql",
+    )
+    prNumSet = set(prNums)
+    missingBranches = sorted(
+        {
+            branch
+            for prNum, branch in headRefs.items()
+            if prNum in prNumSet and branch not in branches
+        }
+    )
+    if missingBranches:
+        raise UnexpectedStateError(
+            f"Expected the branches {missingBranches} for open PRs to already exist. Push all branches for open PRs to {destOrg}/{destRepo} and try again."
+        )
 
 
 def createPrOrIssueObject(url, body, headers=headers):
@@ -184,11 +321,23 @@ def createPrOrIssueObject(url, body, headers=headers):
         logger.debug(body)
         return
     longSleep()
-    requests.post(url, json.dumps(body), headers=headers, timeout=DEFAULT_TIMEOUT)
+    res = requests.post(url, json.dumps(body), headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code == 201:
+        return res.json()
+    logger.warning(f"Got {res.status_code} error from {url}, message: {res.json()}")
+
+
+def getUserMention(login, destOrg):
+    """Mention the GHEC account of a GHES user, or just name users who have
+    none, so that nobody else on github.com gets notified."""
+    cloudLogin = identities.getCloudLogin(login, destOrg)
+    if cloudLogin:
+        return f"@{cloudLogin}"
+    return f"`{login}`"
 
 
 def getPrBody(prNum, user, html_url, prBody):
-    return f"""## :point_right: Substitute PR for [#{prNum}]({html_url}) from @{user} :point_left:
+    return f"""## :point_right: Substitute PR for [#{prNum}]({html_url}) from {user} :point_left:
 
 *Please see the [original pull request #{prNum}]({html_url}) for a full history.*
 
@@ -197,7 +346,7 @@ def getPrBody(prNum, user, html_url, prBody):
 
 
 def getCommentBody(user, commentBody, html_url):
-    return f"""### :point_right: Substitute comment for [original]({html_url}) from @{user} :point_left:
+    return f"""### :point_right: Substitute comment for [original]({html_url}) from {user} :point_left:
 
 This comment was migrated using
 [migratePullRequests.py](https://github.com/example-org/github-migration/blob/main/scripts/migratePullRequests.py)
@@ -207,6 +356,17 @@ from [KEY-32](https://jira.example.com/browse/KEY-32).
 {commentBody}"""
 
 
+def getClosedPrIssueBody(repoPr, prBody):
+    outcome = f"merged at {repoPr['merged_at']}" if repoPr["merged_at"] else "closed"
+    return f"""{prBody}
+
+### Original pull request metadata :point_down:
+* Created at {repoPr["created_at"]}, {outcome}
+* Merging `{repoPr["head"]["ref"]}` into `{repoPr["base"]["ref"]}`
+
+*This closed pull request was migrated as an issue to keep numbering aligned.*"""
+
+
 def updatePr(org, repo, prNumber, body, apiUrl=utils.GHEC_API_URL):
     url = f"{apiUrl}/repos/{org}/{repo}/pulls/{prNumber}"
     body_json = json.dumps(body)
@@ -216,45 +376,160 @@ def updatePr(org, repo, prNumber, body, apiUrl=utils.GHEC_API_URL):
         logger.info(f"Dry run - {message}")
         return
     longSleep()
-    requests.patch(url, body_json, headers=headers, timeout=DEFAULT_TIMEOUT)
+    res = requests.patch(url, body_json, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code != 200:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
 
 
-def createLabels(labelJson, prNum, org, repo, apiUrl=utils.GHEC_API_URL):
-    message = f"Creating labels for {org}/{repo} PR {prNum}"
+def updateIssue(org, repo, issueNumber, body, apiUrl=utils.GHEC_API_URL):
+    url = f"{apiUrl}/repos/{org}/{repo}/issues/{issueNumber}"
+    body_json = json.dumps(body)
+    message = f"Updating issue {url} with {body_json}"
     logger.info(message)
     if dryRun:
         logger.info(f"Dry run - {message}")
-        logger.debug(labelJson)
         return
-    label = []
-    for i in labelJson:
-        label.append(i["name"])
-    url = "{}/repos/{}/{}/issues/{}/labels".format(apiUrl, org, repo, prNum)
-    payload = {"labels": label}
-    logger.info(f"Setting Labels for PR {url}")
     longSleep()
-    requests.post(url, json.dumps(payload), headers=headers, timeout=DEFAULT_TIMEOUT)
+    res = requests.patch(url, body_json, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if res.status_code != 200:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+
+
+def syncLabelsAndMilestones(sourceOrg, sourceRepo, destOrg, destRepo):
+    """Create the source labels and milestones that are missing on the destination.
+
+    Returns a dict of milestone titles to destination milestone numbers, so
+    issues and PRs can set their milestone without looking it up."""
+    sourceUrl = f"{utils.GHES_API_URL}/repos/{sourceOrg}/{sourceRepo}"
+    destUrl = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}"
+    params = {"per_page": "100"}
+
+    destLabels = {
+        label["name"]
+        for label in utils.ghGetPaginated(
+            f"{destUrl}/labels", headers, logger, params=params
+        )
+    }
+    for label in utils.ghGetPaginated(
+        f"{sourceUrl}/labels", sourceHeaders, logger, params=params
+    ):
+        if label["name"] not in destLabels:
+            payload = {
+                "name": label["name"],
+                "color": label["color"],
+                "description": label["description"] or "",
+            }
+            createPrOrIssueObject(f"{destUrl}/labels", payload, headers=headers)
+
+    params = {"per_page": "100", "state": "all"}
+    milestoneNumbers = {
+        milestone["title"]: milestone["number"]
+        for milestone in utils.ghGetPaginated(
+            f"{destUrl}/milestones", headers, logger, params=params
+        )
+    }
+    for milestone in utils.ghGetPaginated(
+        f"{sourceUrl}/milestones", sourceHeaders, logger, params=params
+    ):
+        if milestone["title"] in milestoneNumbers:
+            continue
+        payload = {
+            "title": milestone["title"],
+            "state": milestone["state"],
+            "description": milestone["description"] or "",
+        }
+        if milestone["due_on"]:
+            payload["due_on"] = milestone["due_on"]
+        destMilestone = createPrOrIssueObject(
+            f"{destUrl}/milestones", payload, headers=headers
+        )
+        if destMilestone:
+            milestoneNumbers[milestone["title"]] = destMilestone["number"]
+    return milestoneNumbers
+
+
+def getLabelsAndMilestone(repoPr, milestoneNumbers):
+    """Build the labels and milestone fields of an issue payload."""
+    fields = {"labels": [label["name"] for label in repoPr["labels"]]}
+    if repoPr["milestone"] and repoPr["milestone"]["title"] in milestoneNumbers:
+        fields["milestone"] = milestoneNumbers[repoPr["milestone"]["title"]]
+    return fields
+
+
+def createBatchedReview(
+    repoReviewComments, destOrg, destRepo, prNum, destApiUrl=utils.GHEC_API_URL
+):
+    """Post review comments as a single pull request review.
+
+    Comments whose position no longer resolves on the diff (outdated ones
+    have no line) cannot be part of a review, so they are returned for the
+    caller to post one by one. If GitHub rejects the review, every comment
+    is returned."""
+    reviewComments = []
+    leftovers = []
+    for comments in repoReviewComments:
+        if comments["line"] is None:
+            leftovers.append(comments)
+            continue
+        reviewComment = {
+            "path": comments["path"],
+            "body": getCommentBody(
+                getUserMention(comments["user"]["login"], destOrg),
+                comments["body"],
+                comments["html_url"],
+            ),
+            "line": comments["line"],
+            "side": comments["side"],
+        }
+        if comments["start_line"] is not None:
+            reviewComment["start_line"] = comments["start_line"]
+            reviewComment["start_side"] = comments["start_side"]
+        reviewComments.append(reviewComment)
+    if not reviewComments:
+        return leftovers
+
+    url = f"{destApiUrl}/repos/{destOrg}/{destRepo}/pulls/{prNum}/reviews"
+    payload = {"event": "COMMENT", "comments": reviewComments}
+    message = f"Creating review with {len(reviewComments)} comments {url}"
+    logger.info(message)
+    if dryRun:
+        logger.info(f"Dry run - {message}")
+        logger.debug(payload)
+        return leftovers
+    longSleep()
+    res = requests.post(
+        url, json.dumps(payload), headers=headers, timeout=DEFAULT_TIMEOUT
+    )
+    if res.status_code == 200:
+        return leftovers
+    logger.warning(
+        f"Got {res.status_code} error from {url}, posting review comments one by one, message: {res.json()}"
+    )
+    return repoReviewComments
 
 
 def creatReviewComments(
-    sourceOrg,
-    sourceRepo,
+    repoReviewComments,
     destOrg,
     destRepo,
     prNum,
-    sourceApiUrl=utils.GHES_API_URL,
     destApiUrl=utils.GHEC_API_URL,
 ):
-    url = f"{sourceApiUrl}/repos/{sourceOrg}/{sourceRepo}/pulls/{prNum}/comments"
-    repoReviewComments = getRepoPrComments(url, headers=sourceHeaders)
+    if batchReviewComments:
+        repoReviewComments = createBatchedReview(
+            repoReviewComments, destOrg, destRepo, prNum, destApiUrl=destApiUrl
+        )
     for comments in repoReviewComments:
         payload = {
             "body": getCommentBody(
-                f'{comments["user"]["login"]}_{USER_SUFFIX}',
+                getUserMention(comments["user"]["login"], destOrg),
                 comments["body"],
                 comments["html_url"],
             ),
-            "user": f'{comments["user"]["login"]}_{USER_SUFFIX}',
+            "user": identities.getCloudLogin(comments["user"]["login"], destOrg)
+            or comments["user"]["login"],
             "created_at": f'{comments["created_at"]}',
             "updated_at": f'{comments["updated_at"]}',
             "commit_id": f'{comments["commit_id"]}',
@@ -275,24 +550,21 @@ def creatReviewComments(
 
 
 def createIssueComment(
-    sourceOrg,
-    sourceRepo,
+    repoComments,
     destOrg,
     destRepo,
     prNum,
-    sourceApiUrl=utils.GHES_API_URL,
     destApiUrl=utils.GHEC_API_URL,
 ):
-    url = f"{sourceApiUrl}/repos/{sourceOrg}/{sourceRepo}/issues/{prNum}/comments"
-    repoComments = getRepoPrComments(url, headers=sourceHeaders)
     for comments in repoComments:
         payload = {
             "body": getCommentBody(
-                f'{comments["user"]["login"]}_{USER_SUFFIX}',
+                getUserMention(comments["user"]["login"], destOrg),
                 comments["body"],
-                url,
+                comments["html_url"],
             ),
-            "user": f'{comments["user"]["login"]}_{USER_SUFFIX}',
+            "user": identities.getCloudLogin(comments["user"]["login"], destOrg)
+            or comments["user"]["login"],
             "created_at": f'{comments["created_at"]}',
             "updated_at": f'{comments["updated_at"]}',
         }
@@ -300,231 +572,335 @@ def createIssueComment(
         createPrOrIssueObject(url, payload, headers=headers)
 
 
-# BEGIN main logic of script
-if dryRun:
-    logger.info("Dry run: simulating PR migration")
-else:
-    logger.info("Starting PR migration")
-try:  # noqa: C901
-    for line in sys.stdin:  # noqa: C901
-        if COMMENT_RE.match(line):
-            continue
-        (sourceOrg, sourceRepo, destOrg, destRepo) = utils.getOrgAndRepoPairs(line)
+def fetchSourceItem(sourceOrg, sourceRepo, destOrg, prNum):
+    """Fetch a source PR, or the issue with that number, and render its body.
+
+    Returns (repoPr, isIssue, prBody), with an empty repoPr when the number
+    is neither a PR nor an issue."""
+    utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+    isIssue = False
+    repoPr = getRepoPrDetails(
+        sourceOrg,
+        sourceRepo,
+        prNum,
+        apiUrl=utils.GHES_API_URL,
+        headers=sourceHeaders,
+    )
+    if not repoPr:
+        logger.warning(
+            f"The PR number {prNum} isn't available (it might be an issue, testing ..."
+        )
+        repoPr = getRepoIssuesDetails(
+            sourceOrg,
+            sourceRepo,
+            prNum,
+            apiUrl=utils.GHES_API_URL,
+            headers=sourceHeaders,
+        )
+        if not repoPr:
+            return repoPr, isIssue, ""
+        isIssue = True
+    prBody = getPrBody(
+        prNum,
+        getUserMention(repoPr["user"]["login"], destOrg),
+        repoPr["html_url"],
+        repoPr["body"],
+    )
+    return repoPr, isIssue, prBody
+
+
+def prefetchSourceItems(sourceOrg, sourceRepo, destOrg, prNums, depth=readAhead):
+    """Yield (prNum, repoPr, isIssue, prBody) for prNums, in order.
+
+    Up to depth numbers are fetched from the source in the background while
+    the caller writes the current one to the destination, so source reads
+    do not wait behind the write pacing."""
+    nums = iter(prNums)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque(
+            (
+                prNum,
+                executor.submit(fetchSourceItem, sourceOrg, sourceRepo, destOrg, prNum),
+            )
+            for prNum in islice(nums, depth)
+        )
+        try:
+            while pending:
+                prNum, future = pending.popleft()
+                nextNum = next(nums, None)
+                if nextNum is not None:
+                    pending.append(
+                        (
+                            nextNum,
+                            executor.submit(
+                                fetchSourceItem,
+                                sourceOrg,
+                                sourceRepo,
+                                destOrg,
+                                nextNum,
+                            ),
+                        )
+                    )
+                yield (prNum, *future.result())
+        finally:
+            # Stop background fetches if the caller stops early
+            for _, future in pending:
+                future.cancel()
+
+
+def migrateRepo(sourceOrg, sourceRepo, destOrg, destRepo):  # noqa: C901
+    """Migrate the missing PRs and issues of one repo, in number order."""
+    logger.info(f"Migrating PRs from {sourceOrg}/{sourceRepo} to {destOrg}/{destRepo}")
+
+    utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
+    utils.ghRateLimitSleep(token, logger, instance="github.com")
+
+    prStartNum = utils.getLatestPR(destOrg, destRepo, token, logger) + 1
+    prEndNum = utils.getLatestPR(
+        sourceOrg,
+        sourceRepo,
+        sourceToken,
+        logger,
+        "https://github.example.com/api/graphql",
+    )
+    if checkClosedPrs:
+        destOpenPrs = utils.getOpenPRs(destOrg, destRepo, token, logger)
+        logger.info(
+            f"{len(destOpenPrs)} open PRs found on {destOrg}/{destRepo}: {destOpenPrs}"
+        )
         logger.info(
-            f"Migrating PRs from {sourceOrg}/{sourceRepo} to {destOrg}/{destRepo}"
+            f"Checking open PRs from destination to see if they are already closed on {sourceOrg}/{sourceRepo}"
         )
 
         utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
-        utils.ghRateLimitSleep(token, logger, instance="github.com")
-
-        prStartNum = utils.getLatestPR(destOrg, destRepo, token, logger) + 1
-        prEndNum = utils.getLatestPR(
+        sourceStates = utils.getPrStates(
             sourceOrg,
             sourceRepo,
+            destOpenPrs,
             sourceToken,
             logger,
             "https://github.example.com/api/graphql",
         )
-        dryRunPrIssueNum = prStartNum
-        if checkClosedPrs:
-            destOpenPrs = utils.getOpenPRs(destOrg, destRepo, token, logger)
-            logger.info(
-                f"{len(destOpenPrs)} open PRs found on {destOrg}/{destRepo}: {destOpenPrs}"
-            )
-            logger.info(
-                f"Checking open PRs from destination to see if they are already closed on {sourceOrg}/{sourceRepo}"
-            )
-
-            for prNum in destOpenPrs:
-                utils.ghRateLimitSleep(token, logger, instance="github.com")
-                utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
-                repoPr = getRepoPrDetails(
-                    sourceOrg,
-                    sourceRepo,
-                    prNum,
-                    apiUrl=utils.GHES_API_URL,
-                    headers=sourceHeaders,
+        for prNum in destOpenPrs:
+            state = sourceStates[prNum]
+            if not state:
+                message = f"Expected PR number {prNum} from {destOrg}/{destRepo} to be in {sourceOrg}/{sourceRepo} but it isn't (it could be an issue)"
+                logger.warning(message)
+                continue
+            if state != "OPEN":
+                logger.info(
+                    f"PR number {prNum} from {destOrg}/{destRepo} is {state.lower()} in {sourceOrg}/{sourceRepo}, so close it."
                 )
-                if not repoPr:
-                    message = f"Expected PR number {prNum} from {destOrg}/{destRepo} to be in {sourceOrg}/{sourceRepo} but it isn't (it could be an issue)"
-                    logger.warning(message)
-                    continue
-                if repoPr["state"] != "open":
-                    logger.info(
-                        f"PR number {prNum} from {destOrg}/{destRepo} is {repoPr['state']} in {sourceOrg}/{sourceRepo}, so close it."
-                    )
-                    updatePr(destOrg, destRepo, prNum, {"state": "closed"})
-
-        # runLoop = True
-        # prNum = prStartNum
-        # while runLoop:
-        for prNum in range(prStartNum, prEndNum + 1):
-            isIssue = False
-            utils.ghRateLimitSleep(sourceToken, logger, threshold=120)
-            utils.ghRateLimitSleep(token, logger, instance="github.com")
-            if checkPrNum(prNum, destOrg, destRepo, apiUrl=utils.GHEC_API_URL):
-                logger.warn(
-                    f"PR already exists with number {prNum} in repo {destOrg}/{destRepo}, PR scanning will stop."
+                updatePr(destOrg, destRepo, prNum, {"state": "closed"})
+
+    destNumbers = utils.getIssueAndPrNumbers(destOrg, destRepo, token, logger)
+    # GitHub numbers new items after the highest existing one, so holes below
+    # it cannot be filled with the right number any more
+    nextNum = utils.getNextNumber(destNumbers)
+    holes = utils.getMissingNumbers(destNumbers, prStartNum, min(prEndNum, nextNum - 1))
+    if holes:
+        logger.warning(
+            f"PR numbers {holes} are missing on {destOrg}/{destRepo} below its highest number {nextNum - 1}, so they cannot be migrated"
+        )
+    missingNums = list(range(max(prStartNum, nextNum), prEndNum + 1))
+    logger.info(
+        f"{len(missingNums)} of PR numbers {prStartNum}-{prEndNum} are missing on {destOrg}/{destRepo}"
+    )
+    if missingNums:
+        destBranches = utils.getBranchNames(destOrg, destRepo, token, logger)
+        # The placeholder blob SHA, and placeholder commit SHAs by base SHA
+        placeholders: dict = {"blob": None, "commits": {}}
+        checkOpenPrBranches(
+            sourceOrg, sourceRepo, destOrg, destRepo, missingNums, destBranches
+        )
+        milestoneNumbers = syncLabelsAndMilestones(
+            sourceOrg, sourceRepo, destOrg, destRepo
+        )
+        issueCommentIndex = getRepoCommentIndex(
+            sourceOrg, sourceRepo, "issues", since=commentsSince
+        )
+        reviewCommentIndex = getRepoCommentIndex(
+            sourceOrg, sourceRepo, "pulls", since=commentsSince
+        )
+    for prNum, repoPr, isIssue, PrBody in prefetchSourceItems(
+        sourceOrg, sourceRepo, destOrg, missingNums
+    ):
+        utils.ghRateLimitSleep(token, logger, instance="github.com")
+        if not repoPr:
+            logger.warning(f"The issue number {prNum} isn't available breaking ...")
+            break
+
+        if isIssue:
+            payload = {
+                "title": repoPr["title"],
+                "body": PrBody,
+                **getLabelsAndMilestone(repoPr, milestoneNumbers),
+            }
+            url = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}/issues"
+            newPrNumber = createPrOrIssue(url, payload, prNum, headers=headers)
+            checkNumber(newPrNumber, prNum)
+            if int(repoPr["comments"]) > 0:
+                createIssueComment(
+                    issueCommentIndex[prNum],
+                    destOrg,
+                    destRepo,
+                    prNum,
+                    destApiUrl=utils.GHEC_API_URL,
                 )
-                break
-
-            repoPr = getRepoPrDetails(
-                sourceOrg,
-                sourceRepo,
-                prNum,
-                apiUrl=utils.GHES_API_URL,
-                headers=sourceHeaders,
-            )
-            if not repoPr:
-                logger.warning(
-                    f"The PR number {prNum} isn't available (it might be an issue, testing ..."
+        elif repoPr["state"] != "open" and closedPrMode == "issue":
+            payload = {
+                "title": repoPr["title"],
+                "body": getClosedPrIssueBody(repoPr, PrBody),
+                **getLabelsAndMilestone(repoPr, milestoneNumbers),
+            }
+            url = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}/issues"
+            newPrNumber = createPrOrIssue(url, payload, prNum, headers=headers)
+            countCreated()
+            checkNumber(newPrNumber, prNum)
+            updateIssue(destOrg, destRepo, newPrNumber, {"state": "closed"})
+        else:
+            payload = {
+                "title": repoPr["title"],
+                "body": PrBody,
+                "head": repoPr["head"]["ref"],
+                "base": repoPr["base"]["ref"],
+                "state": "open",
+                "locked": repoPr["locked"],
+                "number": repoPr["number"],
+            }
+            branchExists = repoPr["head"]["ref"] in destBranches
+            if branchExists:
+                logger.info(f'Found branch {repoPr["head"]["ref"]}')
+            elif repoPr["state"] == "open":
+                raise UnexpectedStateError(
+                    f'For open PR {prNum}, expected the branch {repoPr["head"]["ref"]} to already exist. Push all branches for open PRs to {destOrg}/{destRepo} and try again.'
                 )
-                repoPr = getRepoIssuesDetails(
-                    sourceOrg,
-                    sourceRepo,
-                    prNum,
-                    apiUrl=utils.GHES_API_URL,
-                    headers=sourceHeaders,
+            elif closedPrMode == "gitdata":
+                logger.info(
+                    f'Branch {repoPr["head"]["ref"]} not found, creating it on a placeholder commit'
                 )
-                if repoPr:
-                    isIssue = True
-                else:
-                    logger.warning(
-                        f"The issue number {prNum} isn't available breaking ..."
-                    )
-                    break
-            PrTitle = repoPr["title"]
-            PrBody = getPrBody(
-                prNum,
-                f"{repoPr['user']['login']}_{USER_SUFFIX}",
-                repoPr["html_url"],
-                repoPr["body"],
-            )
-
-            if isIssue:
-                payload = {
-                    "title": repoPr["title"],
-                    "body": PrBody,
-                    "milestone": repoPr["milestone"],
-                }
-                url = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}/issues"
-                createPrOrIssue(url, payload, prNum, headers=headers)
-                if int(repoPr["comments"]) > 0:
-                    createIssueComment(
-                        sourceOrg,
-                        sourceRepo,
+                createBranch(
+                    repoPr["head"]["ref"],
+                    getPlaceholderCommit(
+                        repoPr["base"]["sha"],
                         destOrg,
                         destRepo,
-                        prNum,
-                        sourceApiUrl=utils.GHES_API_URL,
-                        destApiUrl=utils.GHEC_API_URL,
-                    )
+                        placeholders,
+                    ),
+                    destOrg,
+                    destRepo,
+                    destBranches,
+                    apiUrl=utils.GHEC_API_URL,
+                )
             else:
-                payload = {
-                    "title": repoPr["title"],
-                    "body": PrBody,
-                    "head": repoPr["head"]["ref"],
-                    "base": repoPr["base"]["ref"],
-                    "state": "open",
-                    "locked": repoPr["locked"],
-                    "number": repoPr["number"],
-                }
-                branchExists = checkBranch(
-                    repoPr["head"]["ref"], destOrg, destRepo, apiUrl=utils.GHEC_API_URL
+                logger.info(f'Branch {repoPr["head"]["ref"]} not found, creating')
+                createBranch(
+                    repoPr["head"]["ref"],
+                    repoPr["base"]["sha"],
+                    destOrg,
+                    destRepo,
+                    destBranches,
+                    apiUrl=utils.GHEC_API_URL,
                 )
-                if branchExists:
-                    logger.info(f'Found branch {repoPr["head"]["ref"]}')
-                elif repoPr["state"] == "open":
-                    raise UnexpectedStateError(
-                        f'For open PR {prNum}, expected the branch {repoPr["head"]["ref"]} to already exist. Push all branches for open PRs to {destOrg}/{destRepo} and try again.'
-                    )
-                else:
-                    logger.info(f'Branch {repoPr["head"]["ref"]} not found, creating')
-                    createBranch(
-                        repoPr["head"]["ref"],
-                        repoPr["base"]["sha"],
-                        destOrg,
-                        destRepo,
-                        apiUrl=utils.GHEC_API_URL,
-                    )
 
-                if repoPr["state"] != "open":
-                    logger.info(f'Creating dummy commit on {repoPr["head"]["ref"]}')
-                    fileContents = f"""This is a _dummy commit_ constructed by
+            if repoPr["state"] != "open" and (
+                branchExists or closedPrMode != "gitdata"
+            ):
+                logger.info(f'Creating dummy commit on {repoPr["head"]["ref"]}')
+                fileContents = f"""This is a _dummy commit_ constructed by
 [migratePullRequests.py](https://github.com/example-org/github-migration/blob/main/scripts/migratePullRequests.py).
 
 *Please see the [original pull request #{prNum}]({repoPr["html_url"]}) for a full history.*"""
 
-                    utils.makeCommit(
+                utils.makeCommit(
+                    destOrg,
+                    destRepo,
+                    token,
+                    repoPr["head"]["ref"],
+                    f'placeholder-{repoPr["head"]["ref"]}.md',
+                    fileContents,
+                    "Dummy commit from migratePullRequests.py for GHCM-32",
+                    fileContents,
+                    repoPr["base"]["sha"],
+                    logger,
+                    graphqlUrl="https://api.github.com/graphql",
+                )
+                longSleep()
+
+            url = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}/pulls"
+            newPrNumber = createPrOrIssue(url, payload, prNum, headers=headers)
+            countCreated()
+            checkNumber(newPrNumber, prNum)
+
+            if repoPr["state"] == "open":
+                # The create pull request endpoint takes neither labels nor a
+                # milestone, so set both in one issue update
+                labelsAndMilestone = getLabelsAndMilestone(repoPr, milestoneNumbers)
+                if labelsAndMilestone["labels"] or "milestone" in labelsAndMilestone:
+                    updateIssue(destOrg, destRepo, newPrNumber, labelsAndMilestone)
+
+                if int(repoPr["comments"]) > 0:
+                    createIssueComment(
+                        issueCommentIndex[prNum],
                         destOrg,
                         destRepo,
-                        token,
-                        repoPr["head"]["ref"],
-                        f'placeholder-{repoPr["head"]["ref"]}.md',
-                        fileContents,
-                        "Dummy commit from migratePullRequests.py for GHCM-32",
-                        fileContents,
-                        repoPr["base"]["sha"],
-                        logger,
-                        graphqlUrl="https://api.github.com/graphql",
+                        newPrNumber,
+                        destApiUrl=utils.GHEC_API_URL,
                     )
-                    longSleep()
-
-                url = f"{utils.GHEC_API_URL}/repos/{destOrg}/{destRepo}/pulls"
-                newPrNumber = createPrOrIssue(url, payload, prNum, headers=headers)
-                prNumCreated += 1
 
-                if repoPr["state"] == "open":
-                    createLabels(
-                        repoPr["labels"],
-                        newPrNumber,
+                if int(repoPr["review_comments"]) > 0:
+                    creatReviewComments(
+                        reviewCommentIndex[prNum],
+                        destOrg,
                         destRepo,
+                        newPrNumber,
+                        destApiUrl=utils.GHEC_API_URL,
+                    )
+            else:
+                url = "{}/repos/{}/{}/pulls/{}".format(
+                    utils.GHEC_API_URL, destOrg, destRepo, newPrNumber
+                )
+                updatePr(destOrg, destRepo, newPrNumber, {"state": "closed"})
+                if not branchExists:
+                    delBranch(
+                        repoPr["head"]["ref"],
                         destOrg,
+                        destRepo,
+                        destBranches,
                         apiUrl=utils.GHEC_API_URL,
                     )
 
-                    if int(repoPr["comments"]) > 0:
-                        createIssueComment(
-                            sourceOrg,
-                            sourceRepo,
-                            destOrg,
-                            destRepo,
-                            newPrNumber,
-                            sourceApiUrl=utils.GHES_API_URL,
-                            destApiUrl=utils.GHEC_API_URL,
-                        )
 
-                    if int(repoPr["review_comments"]) > 0:
-                        creatReviewComments(
-                            sourceOrg,
-                            sourceRepo,
-                            destOrg,
-                            destRepo,
-                            newPrNumber,
-                            sourceApiUrl=utils.GHES_API_URL,
-                            destApiUrl=utils.GHEC_API_URL,
-                        )
-                else:
-                    url = "{}/repos/{}/{}/pulls/{}".format(
-                        utils.GHEC_API_URL, destOrg, destRepo, newPrNumber
-                    )
-                    updatePr(destOrg, destRepo, newPrNumber, {"state": "closed"})
-                    if not branchExists:
-                        delBranch(
-                            repoPr["head"]["ref"],
-                            destRepo,
-                            destOrg,
-                            apiUrl=utils.GHEC_API_URL,
-                        )
-                if newPrNumber != prNum:
-                    message = f"New PR number {newPrNumber} does not match expected PR {prNum} - this is introduced an anomaly."
-                    raise UnexpectedStateError(message)
+def migrateLine(line):
+    migrateRepo(*utils.getOrgAndRepoPairs(line))
+
 
-except Exception:
-    logger.exception("Could not complete PR migration")
-    exitCode = 1
+# BEGIN main logic of script
+if dryRun:
+    logger.info("Dry run: simulating PR migration")
+else:
+    logger.info("Starting PR migration")
+lines = [line.strip() for line in sys.stdin if not COMMENT_RE.match(line)]
+if repoConcurrency > 1:
+    logger.info(f"Migrating {len(lines)} repos, {repoConcurrency} at a time")
+    with ThreadPoolExecutor(max_workers=repoConcurrency) as executor:
+        futures = {executor.submit(migrateLine, line): line for line in lines}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(
+                    f"Could not complete PR migration of {futures[future]}"
+                )
+                exitCode = 1
+else:
+    try:
+        for line in lines:
+            migrateLine(line)
+    except Exception:
+        logger.exception("Could not complete PR migration")
+        exitCode = 1
 
-    # prNum += 1
 if dryRun:
     logger.info(
         f"Dry run: Finished with PR migration, {prNumCreated} PRs would have been created if run for real"
@@ -17,10 +17,12 @@
 #     scripts/migrateWebhook.py < data/repoListPairs.txt
 
 import json
+import os
 import sys
 from time import sleep
-from urllib.parse import urlparse
 
+import dnsResolver
+import hookRules
 import requests
 import utils
 from utils import COMMENT_RE, DEFAULT_TIMEOUT
@@ -33,6 +35,9 @@ export GH_SOURCE_PAT=<The Personal Access Token from GHES>
 
 # Optional Environment Variables
 export GH_ORG=<GHEC org name>
+export HOOK_SNAPSHOT_DIR=<directory to save source hooks in, for later steps to reuse>
+export DNS_CACHE_FILE=<JSON file to cache DNS results in>
+export HOOK_RULES_FILE=<JSON file with the hook URL rewrite rules - data/hookRules.json by default>
 """
 
 logger = utils.getLogger()
@@ -43,22 +48,9 @@ sourceToken = utils.assertGetenv(
     "GH_SOURCE_PAT", "Provide a GitHub Enterprise Server personal access token"
 )
 vaultToken = utils.assertGetenv("VAULT_TOKEN", "Provide a Vault token")
+hookSnapshotDir = os.getenv("HOOK_SNAPSHOT_DIR")
 
 
-REPLAY_DOMAINS = {
-    # The origin domains were "reverse-proxy.example.com",
-    # Assume replay-dev for now, hopefully Chris J
-    "dev": "replay-dev.example.com",
-    # Prod is now a real value
-    "prod": "replay.example.com",
-}
-
-# Require HTTPS for webhook destinations
-PROTO = "https"
-
-
-# Secret lengths for HMAC secrets we generate
-
 headers = {
     "Authorization": f"token {token}",
 }
@@ -66,32 +58,30 @@ sourceHeaders = {
     "Authorization": f"token {sourceToken}",
 }
 
-vaultHeaders = {"X-VAULT-TOKEN": f"{vaultToken}"}
-vaultUri = "https://vault.example.com:8200/v1/secret/data"
+vaultClient = utils.getVaultClient(vaultToken)
 
 
-# Loop through the list of repos from STDIN
 def getRepoHooks(org, repo, headers=headers, apiUrl=utils.GHEC_API_URL):
     url = "{}/repos/{}/{}/hooks".format(apiUrl, org, repo)
-    res = requests.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
-
-    if res.status_code == 200:
-        hooks = res.json()
-        return hooks
-    elif res.status_code == 404:
-        logger.info("No hooks found in {}".format(url))
-        return {}
-    else:
-        logger.error(
-            "Got {} error from {}, message: {}".format(res.status_code, url, res.json())
-        )
-        sys.exit(1)
+    return list(utils.ghGetPaginated(url, headers, logger, params={"per_page": "100"}))
+
+
+def getSourceHooks(sourceOrg, sourceRepo, headers=sourceHeaders):
+    """Fetch the source hooks of a repo once, reusing a saved snapshot if any."""
+    if hookSnapshotDir:
+        hooks = utils.readHookSnapshot(hookSnapshotDir, sourceOrg, sourceRepo)
+        if hooks is not None:
+            logger.info(f"Using saved hook snapshot for {sourceOrg}/{sourceRepo}")
+            return hooks
+    hooks = getRepoHooks(
+        sourceOrg, sourceRepo, headers=headers, apiUrl=utils.GHES_API_URL
+    )
+    if hookSnapshotDir:
+        utils.writeHookSnapshot(hookSnapshotDir, sourceOrg, sourceRepo, hooks)
+    return hooks
 
 
-def getHooksActiveList(
-    sourceOrg, sourceRepo, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-):
-    hooks = getRepoHooks(sourceOrg, sourceRepo, headers=headers, apiUrl=apiUrl)
+def getHooksActiveList(hooks):
     # search in  for active hooks
     hooksActiveList = []
     for hook in hooks:
@@ -103,11 +93,8 @@ def getHooksActiveList(
     return hooksActiveList
 
 
-def getHooksSecretList(
-    sourceOrg, sourceRepo, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-):
-    hooks = getRepoHooks(sourceOrg, sourceRepo, headers=headers, apiUrl=apiUrl)
-    # search in  for active hooks
+def getHooksSecretList(hooks):
+    # search in  for hooks with a secret
     hooksSecretList = []
     for hook in hooks:
         hookUrl = hook["config"]["url"]
@@ -117,157 +104,124 @@ def getHooksSecretList(
 
 
 def getHmacSecret(destOrg, destRepo, hookDomain):
-    mount_point = utils.getVaultMountpoint(hookDomain)
+    mount_point = utils.getVaultMountpoint(hookRules.isDevDestination(hookDomain))
     vaultPath = utils.getVaultPath(hookDomain)
     # Try reading an existing secret for hook domain, create if not found
 
-    hmacSecret = utils.readOrCreateVaultSecret(
-        logger, vaultUri, vaultHeaders, vaultPath, mount_point
+    hmacSecret = utils.readOrCreateVaultSecretCached(
+        logger, vaultClient, vaultPath, mount_point
     )
     return hmacSecret
 
 
+def planWebhook(hook, hookUrl, hookDomain, hooksActiveList, hooksSecretList):
+    """Work out the desired state of a destination hook.
+
+    Returns the desired config, or None to leave the config alone, whether it
+    needs the HMAC secret of the hook domain, and whether it should be active.
+    """
+    hookContentType = hook["config"]["content_type"]
+    if utils.isIpPrivate(hookDomain, logger) and not hookRules.isPublicWithSecret(
+        hookDomain
+    ):
+        # Private hook domains are encoded with the replay service, and
+        # SSL verification is enforced on them. hookUrl is already decoded,
+        # so hooks on the replay service are encoded again the same way
+        config = {
+            "url": hookRules.encodeReplayUrl(hookUrl, hookDomain),
+            "insecure_ssl": "0",
+            "content_type": hookContentType,
+        }
+        needsSecret = True
+    elif hookUrl in hooksSecretList and hookRules.isPublicWithSecret(hookDomain):
+        # If hook URL has a public domain which also has secrets, migrate
+        # those secrets across
+        config = {
+            "url": hookUrl,
+            "insecure_ssl": "0",
+            "content_type": hookContentType,
+        }
+        needsSecret = True
+    else:
+        # If hook URL domain has a public IP address, the destination URL
+        # remains the same.
+        config = None
+        needsSecret = False
+    return config, needsSecret, hookUrl in hooksActiveList
+
+
+def diffWebhook(hook, config, needsSecret, active):
+    """Build the smallest PATCH payload that brings a hook to its desired state.
+
+    GitHub masks hook secrets, so a secret that is already set counts as
+    matching. The config is replaced as a whole, so when any of it differs
+    the secret is sent again along with it.
+    """
+    payload: dict = {}
+    currentConfig = hook["config"]
+    if config is not None and (
+        any(str(currentConfig.get(key)) != str(value) for key, value in config.items())
+        or (needsSecret and "secret" not in currentConfig)
+    ):
+        payload["config"] = dict(config)
+    # Hooks that are inactive in the source are left as they are
+    if active and not hook["active"]:
+        payload["active"] = True
+    return payload
+
+
 def patchWebhook(
     destOrg,
     destRepo,
-    hookUrl,
-    hookContentType,
+    hook,
     hookDomain,
-    hooksActiveList,
-    hooksSecretList,
+    payload,
+    needsSecret,
     apiUrl=utils.GHEC_API_URL,
     headers=headers,
 ):
-    destApiHookUrl = "{}/repos/{}/{}/hooks/{}".format(apiUrl, destOrg, destRepo, hookId)
-    if (
-        utils.isIpPrivate(hookDomain, logger)
-        and hookDomain not in utils.PUBLIC_HOOK_DOMAIN_WITH_SECRET
-    ):
-        hmacSecret = getHmacSecret(destOrg, destRepo, hookDomain)
-
-        logger.info(
-            "Patching webhook URL {} to set HMAC secret for {} for the ultimate destination domain {}".format(
-                destApiHookUrl, hookUrl, hookDomain
-            )
-        )
-        payload = {
-            "config": {
-                "secret": hmacSecret,
-                "content_type": hookContentType,
-                "url": hookUrl,
-            }
-        }
-        sleep(1)
-        utils.ghRateLimitSleep(token, logger, instance="github.com")
-        res = requests.patch(
-            destApiHookUrl,
-            json.dumps(payload),
-            headers=headers,
-            timeout=DEFAULT_TIMEOUT,
-        )
-        if res.status_code == 200:
-            logger.info(
-                "Patched webhook URL {} to set HMAC secret for {} for the ultimate destination domain {}".format(
-                    destApiHookUrl, hookUrl, hookDomain
-                )
-            )
-        elif res.status_code == 404:
-            logger.error("No repo found at {}".format(destApiHookUrl))
-            sys.exit(1)
-        else:
-            logger.error(
-                "{} Error occurred, message {}".format(res.status_code, res.json())
-            )
-            sys.exit(1)
-
-        # The first time we process a private hook domain, we have to encode it
-        # with the replay service.
-        if urlparse(hookUrl).netloc not in REPLAY_DOMAINS.values():
-            urlPath, urlScheme = utils.edit_scheme(hookUrl)
-            if hookDomain in utils.DEV_HOOK_DESTINATIONS:
-                targetEnv = "dev"
-            else:
-                targetEnv = "prod"
-            destHookUrl = "{}://{}/reverse-proxy/path/{}/{}".format(
-                PROTO, REPLAY_DOMAINS[targetEnv], urlScheme, urlPath
-            )
-            logger.info(
-                "Using reverse proxy hook url {} for {} in {}/{}".format(
-                    destHookUrl,
-                    hookUrl,
-                    destOrg,
-                    destRepo,
-                )
-            )
-            # Enforce SSL verification on new webhooks
-            payload = {
-                "config": {
-                    "url": destHookUrl,
-                    "insecure_ssl": 0,
-                    "content_type": hookContentType,
-                    "secret": hmacSecret,
-                }
-            }
-            sleep(1)
-            utils.ghRateLimitSleep(token, logger, instance="github.com")
-            requests.patch(
-                destApiHookUrl,
-                json.dumps(payload),
-                headers=headers,
-                timeout=DEFAULT_TIMEOUT,
-            )
-    elif (
-        hookUrl in hooksSecretList
-        and hookDomain in utils.PUBLIC_HOOK_DOMAIN_WITH_SECRET
-    ):
-        # If hook URL has a public domain which also has secrets, migrate those secrets across
-        destHookUrl = hookUrl
-        mount_point = utils.getVaultMountpoint(hookDomain)
-        vaultPath = utils.getVaultPath(hookDomain)
-        hmacSecret = utils.readOrCreateVaultSecret(
-            logger, vaultUri, vaultHeaders, vaultPath, mount_point
-        )
+    destApiHookUrl = "{}/repos/{}/{}/hooks/{}".format(
+        apiUrl, destOrg, destRepo, hook["id"]
+    )
+    if not payload:
         logger.info(
-            "Adding secret for public IP webhook {} in repo {}/{}".format(
-                destHookUrl, destOrg, destRepo
-            )
+            f"Hook {hook['config']['url']} in repo {destOrg}/{destRepo} is already up to date"
         )
-        payload = {
-            "config": {
-                "url": hookUrl,
-                "insecure_ssl": 0,
-                "content_type": hookContentType,
-                "secret": hmacSecret,
-            }
-        }
-        sleep(1)
-        utils.ghRateLimitSleep(token, logger, instance="github.com")
-        requests.patch(
-            destApiHookUrl,
-            json.dumps(payload),
-            headers=headers,
-            timeout=DEFAULT_TIMEOUT,
+        return
+    if "config" in payload and needsSecret:
+        payload["config"]["secret"] = getHmacSecret(destOrg, destRepo, hookDomain)
+    logger.info(
+        "Patching {} of webhook {} in repo {}/{} for the ultimate destination domain {}".format(
+            ", ".join(payload),
+            payload.get("config", hook["config"])["url"],
+            destOrg,
+            destRepo,
+            hookDomain,
         )
+    )
+    sleep(1)
+    utils.ghRateLimitSleep(token, logger, instance="github.com")
+    res = requests.patch(
+        destApiHookUrl,
+        json.dumps(payload),
+        headers=headers,
+        timeout=DEFAULT_TIMEOUT,
+    )
+    if res.status_code == 200:
+        logger.info("Patched webhook {}".format(destApiHookUrl))
+    elif res.status_code == 404:
+        logger.error("No repo found at {}".format(destApiHookUrl))
+        sys.exit(1)
     else:
-        # If hook URL domain has a public IP address, the destination URL
-        # remains the same.,
-        destHookUrl = hookUrl
-    if hookUrl in hooksActiveList:
-        logger.info(
-            f"marking as active hook: {destHookUrl} in repo: {destOrg}/{destRepo}"
-        )
-        payload = {"active": True}
-        sleep(1)
-        utils.ghRateLimitSleep(token, logger, instance="github.com")
-        requests.patch(
-            destApiHookUrl,
-            json.dumps(payload),
-            headers=headers,
-            timeout=DEFAULT_TIMEOUT,
+        logger.error(
+            "{} Error occurred, message {}".format(res.status_code, res.json())
         )
+        sys.exit(1)
 
 
 # BEGIN main logic of script
+# Read the existing secrets once, so the loop below rarely needs Vault
+utils.prefetchVaultSecrets(logger, vaultClient)
 for line in sys.stdin:  # noqa: C901
     if COMMENT_RE.match(line):
         continue
@@ -281,72 +235,42 @@ for line in sys.stdin:  # noqa: C901
         logger.warning("Skipping {} as it is archived".format(line))
         continue
 
-    hooksActiveList = getHooksActiveList(
-        sourceOrg, sourceRepo, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-    )
-    hooksSecretList = getHooksSecretList(
-        sourceOrg, sourceRepo, headers=sourceHeaders, apiUrl=utils.GHES_API_URL
-    )
+    sourceHooks = getSourceHooks(sourceOrg, sourceRepo, headers=sourceHeaders)
+    # Rewrite the source URLs the same way as the destination ones, once
+    hooksActiveList = hookRules.rewriteHookUrls(getHooksActiveList(sourceHooks))
+    hooksSecretList = hookRules.rewriteHookUrls(getHooksSecretList(sourceHooks))
 
     # Get webhooks in GHEC
     hooks = getRepoHooks(destOrg, destRepo, headers=headers, apiUrl=utils.GHEC_API_URL)
+    # Resolve every hook domain of the repo at once, patchWebhook reuses them
+    dnsResolver.resolveDomains(
+        {
+            hookDomain
+            for _, hookDomain in map(
+                hookRules.rewriteHook, (hook["config"]["url"] for hook in hooks)
+            )
+            if hookDomain is not None
+        },
+        logger,
+    )
 
     for hook in hooks:
         logger.debug("processing hook {}".format(hook))
-        hookUrl = hook["config"]["url"]
-        hookContentType = hook["config"]["content_type"]
-        hookId = hook["id"]
         # the hookDomain is either the main domain in the webook,
         # or we have to crack it out of the path if the webhook uses one of
-        # the reverse proxy domains.
-        hookUrlParsed = urlparse(hookUrl)
-        origHookDomain = hookUrlParsed.netloc
-        if origHookDomain in REPLAY_DOMAINS.values():
-            hookUrlList = hookUrl.split("/", -1)
-            if hookUrlList[4] == "replay_path":
-                hookUrl = "{}://{}".format(hookUrlList[5], "/".join(hookUrlList[6:]))
-                hookDomain = urlparse(hookUrl).netloc
-            else:
-                logger.warning(
-                    "the hook url {} isnt in a familiar format, skipping this hook".format(
-                        hookUrl
-                    )
+        # the reverse proxy domains, then renamed hostnames are mapped.
+        hookUrl, hookDomain = hookRules.rewriteHook(hook["config"]["url"])
+        if hookUrl is None:
+            logger.warning(
+                "the hook url {} isnt in a familiar format, skipping this hook".format(
+                    hook["config"]["url"]
                 )
-                continue
-        else:
-            hookDomain = origHookDomain
-        if hookDomain in utils.OLD_TO_NEW_WEBHOOK_HOSTNAME_MAP.keys():
-            newhookDomain = utils.OLD_TO_NEW_WEBHOOK_HOSTNAME_MAP[hookDomain]
-            hookUrl = urlparse(hookUrl)._replace(netloc=newhookDomain).geturl()
-            hooksActiveListMod = [
-                sub.replace(hookDomain, newhookDomain) for sub in hooksActiveList
-            ]
-            hooksSecretListMod = [
-                sub.replace(hookDomain, newhookDomain) for sub in hooksSecretList
-            ]
-            hookDomain = newhookDomain
-        elif hookDomain in utils.OLD_TO_NEW_WEBHOOK_HOSTNAME_MAP.values():
-            oldhookDomain = [
-                k
-                for k, v in utils.OLD_TO_NEW_WEBHOOK_HOSTNAME_MAP.items()
-                if v == hookDomain
-            ]
-            hooksActiveListMod = [
-                sub.replace(oldhookDomain[0], hookDomain) for sub in hooksActiveList
-            ]
-            hooksSecretListMod = [
-                sub.replace(oldhookDomain[0], hookDomain) for sub in hooksSecretList
-            ]
-        else:
-            hooksActiveListMod = hooksActiveList
-            hooksSecretListMod = hooksActiveList
-
-        patchWebhook(
-            destOrg,
-            destRepo,
-            hookUrl,
-            hookContentType,
-            hookDomain,
-            hooksActiveListMod,
-            hooksSecretListMod,
+            )
+            continue
+
+        # Send at most one PATCH per hook, and none if it already matches
+        config, needsSecret, active = planWebhook(
+            hook, hookUrl, hookDomain, hooksActiveList, hooksSecretList
         )
+        payload = diffWebhook(hook, config, needsSecret, active)
+        patchWebhook(destOrg, destRepo, hook, hookDomain, payload, needsSecret)
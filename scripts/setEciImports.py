@@ -18,15 +18,12 @@
 # Upload the exported archive to the ECI server, once the upload has been completed and migration has been started extract the migration ID and GUID and run this script with this to import users and team properly.
 # Once this script has completed its run, upload the generated csv file and continue with the migration guidance on the webpage,
 
-import functools as ft
-import json
-import re
-from csv import DictWriter
+import os
 
+import eciImports
+import identityIndex
 import utils
-from github import Auth, Github, GithubException
-from python_graphql_client import GraphqlClient
-from utils import USER_SUFFIX
+from github import Auth, Github
 
 """
 # Required Environment Variables
@@ -34,6 +31,12 @@ export GH_PAT=<The Personal Access Token from GHEC>
 export GH_MIGRATION_GUID=<GUID of the ECI migration>
 export GH_MIGRATION_ID=<ID of the ECI migration>
 export GH_ORG=<the org that the migration was triggered for>
+
+# Optional Environment Variables
+export MAPPING_BATCH_SIZE=<how many mappings to send per addImportMapping mutation - 500 by default>
+export IDENTITY_INDEX_FILE=<JSON file to save the identity index in>
+export IDENTITY_INDEX_TTL=<seconds to trust a saved identity index - a day by default>
+export IDENTITY_OVERRIDES_FILE=<JSON file of {"ghes login": "ghec login"} exceptions>
 """
 logger = utils.getLogger()
 
@@ -51,159 +54,17 @@ org = utils.assertGetenv(
 
 auth = Auth.Token(token)
 g = Github(auth=auth)
-client = GraphqlClient(endpoint="https://eci.github.com/api/graphql")
+mappingBatchSize = int(os.getenv("MAPPING_BATCH_SIZE", "500"))
 csv_file = "user_conflicts_{}_{}.csv".format(org, migration_guid)
+identities = identityIndex.IdentityIndex(logger, utils.ghHeaders(token))
+session = eciImports.EciSession(
+    token, logger, identities, mapping_batch_size=mappingBatchSize
+)
 
-
-def make_get_query(migration_guid, org, after_cursor=None):
-    query = """
-query Organization {
-    organization(login: ORG) {
-        migration(guid: GUID) {
-            migratableResources(first: 100 AFTER) {
-                totalCount
-                pageInfo {
-                    endCursor
-                    hasNextPage
-                }
-                edges {
-                    node {
-                        modelName
-                        sourceUrl
-                        targetUrl
-                        state
-                    }
-                }
-            }
-        }
-    }
-}
-"""
-    repls = (
-        ("AFTER", "{}".format(after_cursor)),
-        ("GUID", '"{}"'.format(migration_guid)),
-        ("ORG", '"{}"'.format(org)),
-    )
-    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
-    return res
-
-
-def get_all_users(org):
-    members = []
-    for member in g.get_organization(org).get_members():
-        members.append(member.login)
-    return members
-
-
-def make_set_query(migration_id, dict):
-    json_object = json.dumps(dict, indent=4)
-    query = """
-mutation AddImportMapping {
-    addImportMapping(
-        input: {
-            migrationId: MIGRATION_ID
-            mappings: JSONOBJECT
-        }
-    ) {
-        migration {
-            databaseId
-            guid
-            state
-        }
-    }
-}
-"""
-    repls = ("MIGRATION_ID", '"{}"'.format(migration_id)), (
-        "JSONOBJECT",
-        "{}".format(json_object),
-    )
-    multiline_string = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
-    pattern = r'(?<!\w)"(modelName|sourceUrl|targetUrl|action|MAP|SKIP|MERGE)"(?!\w)'
-    res = re.sub(pattern, r"\1", multiline_string)
-    return res
-
-
-def map_objects(dict, migration_id):
-    query = make_set_query(migration_id, dict)
-    data = client.execute(
-        query,
-        headers={
-            "Authorization": "Bearer {}".format(token),
-            "Graphql-Features": "gh_migrator_import_to_dotcom",
-        },
-    )
-    logger.info("mapped objects: {}".format(data))
-    logger.info("{}".format(query))
-
-
-def fetch_and_resolve_conflicts(org, migration_guid, migration_id, github_team, token):
-    import_file = open(csv_file, "w")
-    writer = DictWriter(import_file, fieldnames=["sourceUrl", "targetUrl"])
-    writer.writeheader()
-    has_next_page = True
-    after_cursor = ""
-    utils.ghRateLimitSleep(token, logger, instance="github.com")
-    users = get_all_users(org)
-
-    while has_next_page:
-        utils.ghRateLimitSleep(token, logger, instance="github.com")
-        data = client.execute(
-            query=make_get_query(migration_guid, org, after_cursor),
-            headers={
-                "Authorization": "Bearer {}".format(token),
-                "Graphql-Features": "gh_migrator_import_to_dotcom",
-            },
-        )
-        users_to_map = []
-        teams_to_merge = []
-        for model in data["data"]["organization"]["migration"]["migratableResources"][
-            "edges"
-        ]:
-            node = model["node"]
-            node["action"] = node.pop("state")
-            if node["modelName"] == "user":
-                user_name = node["sourceUrl"].split("github.example.com/", 1)[1]
-                cloud_user_name = f"{user_name}_{USER_SUFFIX}"
-                node["modelName"] = "undefined"
-                if cloud_user_name in users:
-                    node["targetUrl"] = "https://github.com/{}".format(cloud_user_name)
-                    node["action"] = "MAP"
-                    csv_node = {
-                        k: v for k, v in node.items() if k in ("sourceUrl", "targetUrl")
-                    }
-                    writer.writerow(csv_node)
-                    users_to_map.append(node)
-            if node["modelName"] == "team":
-                node["targetUrl"] = "https://github.com/orgs/{}/teams/{}".format(
-                    org, github_team
-                )
-                node["action"] = "MERGE"
-                node["modelName"] = "undefined"
-                teams_to_merge.append(node)
-        if len(users_to_map) > 0:
-            map_objects(users_to_map, migration_id)
-        if len(teams_to_merge) > 0:
-            map_objects(teams_to_merge, migration_id)
-
-        has_next_page = data["data"]["organization"]["migration"][
-            "migratableResources"
-        ]["pageInfo"]["hasNextPage"]
-        after_cursor = ', after: "{}"'.format(
-            data["data"]["organization"]["migration"]["migratableResources"][
-                "pageInfo"
-            ]["endCursor"]
-        )
-    import_file.close()
-
-
-github_team = "migration_dummy_team"
-github_org = g.get_organization(org)
-
-logger.info("Creating team - {} in org {}".format(github_team, org))
-try:
-    github_org.create_team(github_team, privacy="closed", permission="push")
-except GithubException as e:
-    logger.warning(e.args[1]["message"])
+github_team = eciImports.GITHUB_TEAM
+session.create_team(g.get_organization(org), github_team)
 
 logger.info("Starting object mapping")
-fetch_and_resolve_conflicts(org, migration_guid, migration_id, github_team, token)
+session.fetch_and_resolve_conflicts(
+    org, migration_guid, migration_id, github_team, csv_file
+)
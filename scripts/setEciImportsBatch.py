@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# setEciImportsBatch.py
+#
+# Resolve the user and team conflicts of many ECI migrations at once, like
+# setEciImports.py does for one.
+#
+# Takes a manifest of migrations from STDIN, one org,guid,id per line, with #
+# comments allowed. Each migration is polled, backing off between polls, until
+# it leaves the ECI_WAIT_STATES, and is then mapped if it is in one of the
+# ECI_MAP_STATES. Migrations that end up in any other state, such as FAILED,
+# are reported and make the script exit with 1. The migrations share one org
+# member index and one GraphQL budget.
+#
+# Usage:
+#     scripts/setEciImportsBatch.py < data/eciMigrations.csv
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import eciImports
+import identityIndex
+import utils
+from github import Auth, Github
+from utils import COMMENT_RE
+
+"""
+# Required Environment Variables
+export GH_PAT=<The Personal Access Token from GHEC>
+
+# Optional Environment Variables
+export ECI_CONCURRENCY=<how many migrations to map at once - 4 by default>
+export ECI_QUERIES_PER_MINUTE=<GraphQL budget shared by all migrations - 120 by default>
+export ECI_WAIT_STATES=<comma separated states to wait out before mapping - PENDING,UPLOADING,PREPARING by default>
+export ECI_MAP_STATES=<comma separated states a migration must be in to be mapped - CONFLICTS,READY by default>
+export ECI_MAX_WAIT=<seconds to wait for a migration to leave ECI_WAIT_STATES - 4 hours by default>
+export MAPPING_BATCH_SIZE=<how many mappings to send per addImportMapping mutation - 500 by default>
+export IDENTITY_INDEX_FILE=<JSON file to save the identity index in>
+export IDENTITY_INDEX_TTL=<seconds to trust a saved identity index - a day by default>
+export IDENTITY_OVERRIDES_FILE=<JSON file of {"ghes login": "ghec login"} exceptions>
+"""
+logger = utils.getLogger()
+
+token = utils.assertGetenv("GH_PAT", "Provide a GitHub.com personal access token")
+eciConcurrency = int(os.getenv("ECI_CONCURRENCY", "4"))
+queriesPerMinute = int(os.getenv("ECI_QUERIES_PER_MINUTE", "120"))
+waitStates = set(
+    os.getenv("ECI_WAIT_STATES", "PENDING,UPLOADING,PREPARING").upper().split(",")
+)
+mapStates = set(os.getenv("ECI_MAP_STATES", "CONFLICTS,READY").upper().split(","))
+maxWait = int(os.getenv("ECI_MAX_WAIT", str(eciImports.DEFAULT_MAX_WAIT)))
+mappingBatchSize = int(os.getenv("MAPPING_BATCH_SIZE", "500"))
+
+g = Github(auth=Auth.Token(token))
+identities = identityIndex.IdentityIndex(logger, utils.ghHeaders(token))
+session = eciImports.EciSession(
+    token,
+    logger,
+    identities,
+    bucket=utils.TokenBucket(queriesPerMinute / 60, capacity=eciConcurrency),
+    mapping_batch_size=mappingBatchSize,
+)
+
+
+def resolveMigration(org, guid, migrationId):
+    """Wait for a migration to be ready, map it, and return its state.
+
+    Raises utils.UnexpectedStateError if it ends up in a state other than
+    mapStates, such as FAILED, without mapping it."""
+    state = session.wait_for_state(org, guid, waitStates, max_wait=maxWait)
+    if state not in mapStates:
+        raise utils.UnexpectedStateError(
+            "Migration {} in {} is {}, not mapping it".format(guid, org, state)
+        )
+    logger.info("Migration {} in {} is {}, mapping it".format(guid, org, state))
+    session.fetch_and_resolve_conflicts(
+        org,
+        guid,
+        migrationId,
+        eciImports.GITHUB_TEAM,
+        "user_conflicts_{}_{}.csv".format(org, guid),
+    )
+    return session.get_state(org, guid)
+
+
+# BEGIN main logic of script
+migrations = []
+for lineNumber, line in enumerate(sys.stdin, 1):
+    if COMMENT_RE.match(line):
+        continue
+    migration = tuple(field.strip() for field in line.split(","))
+    if len(migration) != 3 or not all(migration):
+        logger.error(
+            "Line {} of the manifest is not org,guid,id: {}".format(
+                lineNumber, line.strip()
+            )
+        )
+        sys.exit(1)
+    migrations.append(migration)
+for migrationOrg in sorted({org for org, _, _ in migrations}):
+    session.create_team(g.get_organization(migrationOrg))
+
+states = {}
+with ThreadPoolExecutor(max_workers=eciConcurrency) as executor:
+    futures = {
+        executor.submit(resolveMigration, *migration): migration
+        for migration in migrations
+    }
+    for future in as_completed(futures):
+        org, guid, _ = futures[future]
+        try:
+            states[(org, guid)] = future.result()
+        except Exception as e:
+            logger.error("Could not map migration {} in {}: {}".format(guid, org, e))
+            states[(org, guid)] = None
+
+for (org, guid), state in sorted(states.items()):
+    logger.info("{} {}: {}".format(org, guid, state or "FAILED TO MAP"))
+if None in states.values():
+    sys.exit(1)
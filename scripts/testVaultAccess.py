@@ -28,16 +28,10 @@ SECRET_CHARS = string.ascii_uppercase + string.ascii_lowercase + string.digits
 warnings = 0
 
 logger.info("Logging into vault")
-client = hvac.Client(
-    url="https://vault.example.com:8200",
-    token=vaultToken,
-)
-for namespace in ["prod", "dev"]:
-    path = "reverse-proxy/"
-    mount_point = "/langplats/{}/kv/secrets".format(namespace)
-    logger.info(
-        "Listing secrets for {} in mountpoint {}".format(namespace, mount_point)
-    )
+client = utils.getVaultClient(vaultToken)
+for mount_point in utils.VAULT_MOUNTPOINTS:
+    path = utils.VAULT_PATH_PREFIX
+    logger.info("Listing secrets in mountpoint {}".format(mount_point))
     try:
         list_response = client.secrets.kv.v2.list_secrets(
             path=path,
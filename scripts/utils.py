@@ -6,21 +6,25 @@ import base64
 # Functions used by multiple scripts
 import datetime
 import functools as ft
-import ipaddress
 import json
 import logging
 import os
 import re
-import socket
 import string
 import sys
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from secrets import choice
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
 import __main__
+import dnsResolver
+import hvac
 import requests
 from python_graphql_client import GraphqlClient
+from requests.adapters import HTTPAdapter
 
 _SECRET_LENGTH = 40
 _SECRET_CHARS = string.ascii_uppercase + string.ascii_lowercase + string.digits
@@ -40,6 +44,8 @@ org2
 COMMENT_RE = re.compile(r"^\s*(#.*|)$")
 
 DEFAULT_TIMEOUT = 300
+# GitHub's secondary rate limit on requests that create content, per token
+GHEC_CONTENT_CREATION_PER_MINUTE = 80
 
 
 class UnexpectedStateError(Exception):
@@ -67,6 +73,22 @@ def assertGetenv(envVar, message=""):
     return env
 
 
+def getenvChoice(envVar, choices, default):
+    """Return an environment variable that must be one of choices."""
+    env = os.getenv(envVar, default)
+    if env not in choices:
+        raise AssertionError(
+            "Environment variable '{}' is {}, expected one of {}".format(
+                envVar, env, ", ".join(choices)
+            )
+        )
+    return env
+
+
+# How migratePullRequests.py can recreate closed PRs
+CLOSED_PR_MODES = ("gitdata", "commit", "issue")
+
+
 class CustomFormatter(logging.Formatter):
     green = "\033[1;32m"
     grey = "\033[1;20m"
@@ -122,41 +144,39 @@ def getVaultSecretKeyName(hookDomain):
     return "{}".format(hookDomain.replace(".", "_").upper())
 
 
-def getVaultPath(hookDomain):
-    return "reverse-proxy/{}".format(getVaultSecretKeyName(hookDomain))
+VAULT_PATH_PREFIX = "reverse-proxy/"
+
 
+def getVaultPath(hookDomain):
+    return "{}{}".format(VAULT_PATH_PREFIX, getVaultSecretKeyName(hookDomain))
 
-# TODO put in list of real prod domains to differentiate.
-# Consider reading it in from a text file instead of hardcoding it here,
-# if this list grows beyond a dozen or so.
-DEV_HOOK_DESTINATIONS = ["some-destionation.example.com"]
 
-PUBLIC_HOOK_DOMAIN_WITH_SECRET = [
-    "admin.example.com",
+VAULT_MOUNTPOINT = "langplats/{}/kv/secrets"
+VAULT_MOUNTPOINTS = [
+    VAULT_MOUNTPOINT.format(namespace) for namespace in ["prod", "dev"]
 ]
 
 
-def getVaultMountpoint(hookDomain):
-    if hookDomain in DEV_HOOK_DESTINATIONS:
+def getVaultMountpoint(isDevDestination):
+    """Return the mount point of a hook domain's secret, from whether
+    hookRules.isDevDestination holds for it."""
+    if isDevDestination:
         namespace = "dev"
     else:
         namespace = "prod"
-    return "langplats/{}/kv/secrets".format(namespace)
+    return VAULT_MOUNTPOINT.format(namespace)
 
 
 def isIpPrivate(domain, logger):
-    try:
-        ip = socket.gethostbyname(domain)
-        isIpPrivate = ipaddress.ip_address(ip).is_private
-    except socket.gaierror as err:
-        isIpPrivate = True
+    result = dnsResolver.resolveDomains([domain], logger)[domain]
+    if result["type"] == dnsResolver.UNRESOLVABLE:
         logger.info(
             "IP of {} is not resolvable, assigning as Private. Resolver message: {}".format(
-                domain, err
+                domain, result["error"]
             )
         )
-
-    return isIpPrivate
+        return True
+    return result["type"] == dnsResolver.PRIVATE
 
 
 def ghHeaders(ghAuthToken):
@@ -202,20 +222,93 @@ def ghRateResetSeconds(ghAuthToken, instance="github.example.com"):
     return result.seconds
 
 
+# One lock per instance, so that when one thread sleeps until the rate limit
+# resets, every other thread that also finds it low waits with it. Probes
+# with plenty remaining never wait for the lock.
+_rateLimitLocks: dict = defaultdict(threading.Lock)
+
+
 def ghRateLimitSleep(ghAuthToken, logger, instance="github.example.com", threshold=120):
     remaining = ghRateRemaining(ghAuthToken, instance)
-    if remaining < threshold:
-        sleepTime = ghRateResetSeconds(ghAuthToken, instance) + threshold
-        logger.info(
-            f"Remaining ratelimit {remaining} is less than {threshold}, sleeping {sleepTime} seconds"
-        )
-        time.sleep(sleepTime)
-    else:
+    if remaining >= threshold:
         logger.debug(
             "Remaining ratelimit {} is at least {}, no sleep required".format(
                 remaining, threshold
             )
         )
+        return
+    with _rateLimitLocks[instance]:
+        # Probe again, the limit may have reset while another thread slept
+        remaining = ghRateRemaining(ghAuthToken, instance)
+        if remaining < threshold:
+            sleepTime = ghRateResetSeconds(ghAuthToken, instance) + threshold
+            logger.info(
+                f"Remaining ratelimit {remaining} is less than {threshold}, sleeping {sleepTime} seconds"
+            )
+            time.sleep(sleepTime)
+
+
+class TokenBucket:
+    """Pace calls shared between threads to a steady rate.
+
+    acquire() blocks until a token is available. Tokens refill at rate per
+    second, up to capacity."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Going below zero reserves the next token for this caller
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(wait)
+
+
+def ghGetPaginated(url, headers, logger, params=None, key=None):
+    """Yield every item of a paginated GitHub REST listing.
+
+    Follows the Link header until there is no next page. Set key when the
+    listing wraps its items in an object, like /installations does."""
+    while url:
+        res = requests.get(url, headers=headers, params=params, timeout=DEFAULT_TIMEOUT)
+        if res.status_code == 404:
+            logger.info(f"Nothing found in {url}")
+            return
+        elif res.status_code != 200:
+            message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+            raise UnexpectedStateError(message)
+        page = res.json()
+        yield from page[key] if key else page
+        url = res.links.get("next", {}).get("url")
+        # The next link already carries the query string
+        params = None
+
+
+def ghCountItems(url, headers, logger, params=None):
+    """Count the items of a paginated GitHub REST listing with a single call.
+
+    Asks for one item per page and reads the page number of the last link."""
+    params = {**(params or {}), "per_page": "1"}
+    res = requests.get(url, headers=headers, params=params, timeout=DEFAULT_TIMEOUT)
+    if res.status_code == 404:
+        logger.info(f"Nothing found in {url}")
+        return 0
+    elif res.status_code != 200:
+        message = f"Got {res.status_code} error from {url}, message: {res.json()}"
+        raise UnexpectedStateError(message)
+    if "last" in res.links:
+        return int(parse_qs(urlparse(res.links["last"]["url"]).query)["page"][0])
+    return len(res.json())
 
 
 # Thanks https://stackoverflow.com/a/1883251 for the hint on reliably
@@ -259,62 +352,250 @@ def getOrgAndRepoPairs(line):
         return org[8:], repo, org, repo
 
 
+VAULT_URL = "https://vault.example.com:8200"
+VAULT_POOL_SIZE = 16
+
+_vaultClients: dict = {}
+_vaultClientsLock = threading.Lock()
+
+
+def getVaultClient(vaultToken, url=VAULT_URL):
+    """Return the shared hvac client for a token, creating it on first use.
+
+    Its session keeps a pool of connections, so threads reading secrets
+    concurrently reuse them instead of connecting for every request."""
+    with _vaultClientsLock:
+        if (url, vaultToken) not in _vaultClients:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=VAULT_POOL_SIZE, pool_maxsize=VAULT_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+            _vaultClients[(url, vaultToken)] = hvac.Client(
+                url=url, token=vaultToken, session=session, timeout=DEFAULT_TIMEOUT
+            )
+        return _vaultClients[(url, vaultToken)]
+
+
 def createVaultSecret(
-    logger, vaultUri, vaultHeaders, mount_point, vaultPath, hmacSecret
+    logger, vaultClient, mount_point, vaultPath, hmacSecret, cas=None
 ):
-    secret = {
-        "data": {
-            "value": hmacSecret,
-        }
-    }
+    """Write a secret to Vault.
 
-    url = "{}/{}/{}".format(vaultUri, mount_point, vaultPath)
+    With cas set, Vault's KV v2 check-and-set only writes the secret if its
+    current version is cas, 0 meaning none exists yet. Returns False if
+    another writer got there first."""
     try:
-        logger.info(
-            "Writing secret to {} in {} with url {}".format(mount_point, vaultPath, url)
+        logger.info("Writing secret to {} in {}".format(vaultPath, mount_point))
+        create_response = vaultClient.secrets.kv.v2.create_or_update_secret(
+            path=vaultPath,
+            secret={"value": hmacSecret},
+            cas=cas,
+            mount_point=mount_point,
         )
-        create_response = requests.post(
-            url, data=json.dumps(secret), headers=vaultHeaders, timeout=DEFAULT_TIMEOUT
+        logger.info(create_response)
+    except hvac.exceptions.InvalidRequest as e:
+        if cas is None:
+            logger.warning(e)
+            logger.error(
+                "Could not create secret in {} at {}".format(mount_point, vaultPath)
+            )
+            sys.exit(1)
+        logger.info(
+            "Secret in {} at {} already exists, message {}".format(
+                mount_point, vaultPath, e
+            )
         )
-        create_response.raise_for_status()
-        logger.info(create_response.json())
+        return False
     except Exception as e:
         logger.warning(e)
         logger.error(
             "Could not create secret in {} at {}".format(mount_point, vaultPath)
         )
         sys.exit(1)
+    return True
 
 
-def readOrCreateVaultSecret(logger, vaultUri, vaultHeaders, vaultPath, mount_point):
+def readVaultSecretVersion(logger, vaultClient, vaultPath, mount_point):
+    """Return the value of a secret and its current version.
+
+    The value is None if there is no such secret or its current version is
+    deleted, and the version is 0 if the secret was never written. Both can
+    be passed on to createVaultSecret as cas."""
+    logger.info("Retrieving secret {} from {}".format(vaultPath, mount_point))
     try:
-        logger.info("Retrieving secret {} from {}".format(vaultPath, mount_point))
-        url = "{}/{}/{}".format(vaultUri, mount_point, vaultPath)
-        read_response = requests.get(url, headers=vaultHeaders, timeout=DEFAULT_TIMEOUT)
-        read_response.raise_for_status()
-        hmacSecret = read_response.json()["data"]["data"]["value"]
-    except requests.exceptions.HTTPError as e:
-        logger.debug(read_response.json())
-        if read_response.status_code == 400:
+        read_response = vaultClient.secrets.kv.v2.read_secret_version(
+            path=vaultPath, mount_point=mount_point, raise_on_deleted_version=False
+        )
+    except hvac.exceptions.InvalidPath as e:
+        logger.debug(e)
+        return None, 0
+    except Exception as e:
+        logger.error(
+            "Could not read secret {} from {}, message {}".format(
+                vaultPath, mount_point, e
+            )
+        )
+        sys.exit(1)
+    data = read_response["data"]
+    version = data["metadata"]["version"]
+    if not data["data"]:
+        logger.info(
+            "Version {} of secret {} in {} is deleted".format(
+                version, vaultPath, mount_point
+            )
+        )
+        return None, version
+    return data["data"]["value"], version
+
+
+def readVaultSecret(logger, vaultClient, vaultPath, mount_point):
+    """Return the value of a secret, or None if there is no such secret."""
+    return readVaultSecretVersion(logger, vaultClient, vaultPath, mount_point)[0]
+
+
+# Before the per-namespace mount points, the secrets were kept in the KV v2
+# engine mounted at secret/, as {mount_point}/{vaultPath}
+LEGACY_VAULT_MOUNTPOINT = "secret"
+
+
+def readLegacyVaultSecret(logger, vaultClient, vaultPath, mount_point):
+    """Return the value of a secret from the old layout, or None."""
+    legacyPath = "{}/{}".format(mount_point, vaultPath)
+    return readVaultSecret(logger, vaultClient, legacyPath, LEGACY_VAULT_MOUNTPOINT)
+
+
+VAULT_CREATE_ATTEMPTS = 3
+
+
+def readOrCreateVaultSecret(logger, vaultClient, vaultPath, mount_point):
+    """Return a secret, generating and writing it if it is missing or deleted.
+
+    A secret that only exists in the old layout is copied over instead, so
+    hooks keep the secret their receivers already know. The write is a
+    check-and-set against the version that was read, so if another writer
+    got there first, their secret is read and used instead."""
+    for _ in range(VAULT_CREATE_ATTEMPTS):
+        hmacSecret, version = readVaultSecretVersion(
+            logger, vaultClient, vaultPath, mount_point
+        )
+        if hmacSecret is not None:
+            return hmacSecret
+        if version == 0:
+            hmacSecret = readLegacyVaultSecret(
+                logger, vaultClient, vaultPath, mount_point
+            )
+        if hmacSecret is not None:
             logger.info(
-                "No secret found under {} in {}, generating new HMAC secret, message={}".format(
-                    mount_point, vaultPath, e
+                "Copying secret {} in {} from the old layout".format(
+                    vaultPath, mount_point
                 )
             )
-            hmacSecret = getRandomToken()
-            # generate new random secret, upload to vault and assign this to the newsecret variable
-            createVaultSecret(
-                logger, vaultUri, vaultHeaders, mount_point, vaultPath, hmacSecret
-            )
         else:
-            logger.error(
-                "{} Error occurred, message {}".format(
-                    read_response.status_code, read_response.json()
+            logger.info(
+                "No secret found under {} in {}, generating new HMAC secret".format(
+                    mount_point, vaultPath
                 )
             )
-            sys.exit(1)
+            hmacSecret = getRandomToken()
+        # generate new random secret, upload to vault and assign this to the newsecret variable
+        if createVaultSecret(
+            logger, vaultClient, mount_point, vaultPath, hmacSecret, cas=version
+        ):
+            return hmacSecret
+    logger.error(
+        "Could not read or create secret in {} at {} after {} attempts".format(
+            mount_point, vaultPath, VAULT_CREATE_ATTEMPTS
+        )
+    )
+    sys.exit(1)
+
+
+# HMAC secrets by (mount_point, vaultPath). They are only kept in memory:
+# Vault stays the only store of hook secrets, and nothing leaves them behind
+# on disk once a script exits.
+vaultSecretCache: dict = {}
+_vaultSecretLocks: dict = defaultdict(threading.Lock)
+_vaultSecretLocksLock = threading.Lock()
+
+
+def readOrCreateVaultSecretCached(logger, vaultClient, vaultPath, mount_point):
+    """Like readOrCreateVaultSecret, but asks Vault at most once per secret.
+
+    Threads asking for the same secret wait for the first one, so they never
+    race to create two different secrets for one domain."""
+    key = (mount_point, vaultPath)
+    if key in vaultSecretCache:
+        return vaultSecretCache[key]
+    with _vaultSecretLocksLock:
+        lock = _vaultSecretLocks[key]
+    with lock:
+        if key not in vaultSecretCache:
+            vaultSecretCache[key] = readOrCreateVaultSecret(
+                logger, vaultClient, vaultPath, mount_point
+            )
+    return vaultSecretCache[key]
+
+
+def prefetchVaultSecrets(
+    logger, vaultClient, mountPoints=VAULT_MOUNTPOINTS, workers=VAULT_POOL_SIZE
+):
+    """Read every existing hook secret into vaultSecretCache up front.
+
+    Lists reverse-proxy/ under each mount point, then reads the secrets
+    concurrently, so the scripts hardly ask Vault anything while migrating."""
+    paths = []
+    for mount_point in mountPoints:
+        try:
+            listing = vaultClient.secrets.kv.v2.list_secrets(
+                path=VAULT_PATH_PREFIX, mount_point=mount_point
+            )
+        except hvac.exceptions.InvalidPath:
+            logger.info(
+                "No secrets found under {} in {}".format(VAULT_PATH_PREFIX, mount_point)
+            )
+            continue
+        paths.extend(
+            (mount_point, VAULT_PATH_PREFIX + key)
+            for key in listing["data"]["keys"]
+            if not key.endswith("/")
+            and (mount_point, VAULT_PATH_PREFIX + key) not in vaultSecretCache
+        )
+    logger.info("Prefetching {} secrets from Vault".format(len(paths)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        values = executor.map(
+            lambda path: readVaultSecret(logger, vaultClient, path[1], path[0]), paths
+        )
+        for key, value in zip(paths, values):
+            if value is not None:
+                vaultSecretCache.setdefault(key, value)
 
-    return hmacSecret
+
+def ensureVaultSecrets(
+    logger, vaultClient, hookDomains, isDevDestination, workers=VAULT_POOL_SIZE
+):
+    """Return the secrets of many hook domains, creating the missing ones
+    concurrently. isDevDestination is hookRules.isDevDestination."""
+    keys = {
+        hookDomain: (
+            getVaultMountpoint(isDevDestination(hookDomain)),
+            getVaultPath(hookDomain),
+        )
+        for hookDomain in hookDomains
+    }
+    missing = {key for key in keys.values() if key not in vaultSecretCache}
+    if missing:
+        logger.info("Creating {} missing secrets in Vault".format(len(missing)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(
+                executor.map(
+                    lambda key: readOrCreateVaultSecretCached(
+                        logger, vaultClient, key[1], key[0]
+                    ),
+                    missing,
+                )
+            )
+    return {hookDomain: vaultSecretCache[key] for hookDomain, key in keys.items()}
 
 
 def getRepoDetails(logger, org, repo, headers, apiUrl=GHEC_API_URL):
@@ -334,18 +615,83 @@ def getRepoDetails(logger, org, repo, headers, apiUrl=GHEC_API_URL):
         sys.exit(1)
 
 
+def getHookSnapshotPath(snapshotDir, org, repo):
+    # One directory per org, as org and repo names may both contain "-"
+    return os.path.join(snapshotDir, org, f"hooks-{repo}.json")
+
+
+def readHookSnapshot(snapshotDir, org, repo):
+    """Return the saved source hooks of a repo, or None if there are none."""
+    try:
+        with open(getHookSnapshotPath(snapshotDir, org, repo), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def writeHookSnapshot(snapshotDir, org, repo, hooks):
+    snapshotPath = getHookSnapshotPath(snapshotDir, org, repo)
+    os.makedirs(os.path.dirname(snapshotPath), exist_ok=True)
+    with open(snapshotPath, "w") as f:
+        json.dump(hooks, f, indent=2)
+
+
+def buildTeamRepoIndex(org, headers, logger, apiUrl=GHES_API_URL, workers=8):
+    """Invert the teams of an org into {repo name: [team, ...]}.
+
+    Lists the repos of every team once, instead of the teams of every repo.
+    Each team entry has the slug and permissions that the repo's /teams
+    listing would have given."""
+    teamsUrl = f"{apiUrl}/orgs/{org}/teams"
+    slugs = [
+        team["slug"]
+        for team in ghGetPaginated(
+            teamsUrl, headers, logger, params={"per_page": "100"}
+        )
+    ]
+    logger.info(f"Indexing the repos of {len(slugs)} teams in {org}")
+
+    def getTeamRepos(slug):
+        url = f"{teamsUrl}/{slug}/repos"
+        return list(ghGetPaginated(url, headers, logger, params={"per_page": "100"}))
+
+    index: dict = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for slug, repos in zip(slugs, executor.map(getTeamRepos, slugs)):
+            for repo in repos:
+                index[repo["name"].lower()].append(
+                    {"slug": slug, "permissions": repo["permissions"]}
+                )
+    return dict(index)
+
+
+def getTeamRepoIndexPath(indexDir, org):
+    return os.path.join(indexDir, f"teams-{org}.json")
+
+
+def readTeamRepoIndex(indexDir, org):
+    """Return the saved team index of an org, or None if there is none."""
+    try:
+        with open(getTeamRepoIndexPath(indexDir, org), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def writeTeamRepoIndex(indexDir, org, index):
+    os.makedirs(indexDir, exist_ok=True)
+    with open(getTeamRepoIndexPath(indexDir, org), "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
 # Maps the name of apps in GHES to GHEC, this was crafted in 2024-02-04.
 GHES_TO_GHEC_APP_NAME_MATCH = {
     "sourceapp": "destapp-ghec",
     "foo": "foo-ghec",
 }
 
-OLD_TO_NEW_WEBHOOK_HOSTNAME_MAP = {
-    "cxflow.example.com": "cxflow.newexample.com",
-}
-
 
-def makeGetPrsQuery(org, repo, logger, count, qualifier=""):
+def makeGetPrsQuery(org, repo, logger, count, qualifier="", fields="number"):
     query = """
 query Repository {
     repository(
@@ -358,7 +704,7 @@ query Repository {
           orderBy: { direction: DESC, field: CREATED_AT},
           first: COUNT) {
             nodes {
-                number
+                FIELDS
             }
           pageInfo {
             endCursor
@@ -375,6 +721,7 @@ query Repository {
         ("REPO", repo),
         ("COUNT", str(count)),
         ("QUALIFIER", qualifier),
+        ("FIELDS", fields),
     )
     res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
 
@@ -425,6 +772,295 @@ def getOpenPRs(
     return prs
 
 
+def getOpenPrHeadRefs(
+    org, repo, ghAuthToken, logger, graphqlUrl="https://api.github.com/graphql"
+):
+    """Return a dict of open pull request numbers to their head branch names."""
+    client = GraphqlClient(endpoint=graphqlUrl)
+    morePages = True
+    headRefs = {}
+    base_qualifier = "states: OPEN,"
+    qualifier = base_qualifier
+    while morePages:
+        data = client.execute(
+            query=makeGetPrsQuery(
+                org, repo, logger, 100, qualifier=qualifier, fields="number headRefName"
+            ),
+            headers=ghGraphqlHeaders(ghAuthToken),
+        )
+        pullRequests = data["data"]["repository"]["pullRequests"]
+        for node in pullRequests["nodes"]:
+            headRefs[int(node["number"])] = node["headRefName"]
+        morePages = pullRequests["pageInfo"]["hasNextPage"]
+        if morePages:
+            cursor = pullRequests["pageInfo"]["endCursor"]
+            qualifier = f'{base_qualifier} after: "{cursor}",'
+    return headRefs
+
+
+def raiseOnGraphqlErrors(data, message):
+    """Raise UnexpectedStateError if a GraphQL query failed.
+
+    Aliased objects that were not found only give NOT_FOUND errors, and
+    are left to the caller to treat as null. Any other error, or a
+    response without data, fails the whole query."""
+    errors = data.get("errors") or []
+    if data.get("data") is None or any(
+        error.get("type") != "NOT_FOUND" for error in errors
+    ):
+        raise UnexpectedStateError(f"{message}, errors: {errors}")
+
+
+def makeGetPrStatesQuery(org, repo, prNums, logger):
+    fields = "\n".join(
+        f"        pr{prNum}: pullRequest(number: {prNum}) {{ state }}"
+        for prNum in prNums
+    )
+    query = """
+query Repository {
+    repository(
+        owner: "ORG"
+        name: "REPO"
+        followRenames: true
+    ) {
+FIELDS
+    }
+}
+"""
+    repls = (
+        ("ORG", org),
+        ("REPO", repo),
+        ("FIELDS", fields),
+    )
+    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+
+    logger.debug(res)
+    return res
+
+
+def getPrStates(
+    org,
+    repo,
+    prNums,
+    ghAuthToken,
+    logger,
+    graphqlUrl="https://api.github.com/graphql",
+    batchSize=100,
+):
+    """Return a dict of pull request numbers to OPEN, CLOSED or MERGED.
+
+    Numbers are looked up batchSize at a time with aliased pullRequest
+    fields. Numbers that are not pull requests map to None."""
+    client = GraphqlClient(endpoint=graphqlUrl)
+    states = {}
+    for i in range(0, len(prNums), batchSize):
+        batch = prNums[i : i + batchSize]
+        data = client.execute(
+            query=makeGetPrStatesQuery(org, repo, batch, logger),
+            headers=ghGraphqlHeaders(ghAuthToken),
+        )
+        raiseOnGraphqlErrors(data, f"Could not get pull request states of {org}/{repo}")
+        # Numbers that are not pull requests come back as null with an error
+        repository = data["data"].get("repository") or {}
+        for prNum in batch:
+            pr = repository.get(f"pr{prNum}")
+            states[prNum] = pr["state"] if pr else None
+    return states
+
+
+def makeGetRepoIdsQuery(repos, logger):
+    query = "\n".join(
+        ["query Repositories {"]
+        + [
+            f"""    r{i}: repository(owner: "{org}", name: "{repo}") {{
+        databaseId
+        isArchived
+    }}"""
+            for i, (org, repo) in enumerate(repos)
+        ]
+        + ["}"]
+    )
+    logger.debug(query)
+    return query
+
+
+# {(graphqlUrl, org, repo): {"databaseId": ..., "isArchived": ...} or None}
+repoIdCache: dict = {}
+
+
+def getRepoIds(
+    repos,
+    ghAuthToken,
+    logger,
+    graphqlUrl="https://api.github.com/graphql",
+    batchSize=50,
+):
+    """Return a dict of (org, repo) to the repo's databaseId and isArchived.
+
+    Repos are looked up batchSize at a time with aliased repository fields,
+    and remembered, so asking again costs nothing. Repos that do not exist
+    map to None."""
+    client = GraphqlClient(endpoint=graphqlUrl)
+    unknown = list(
+        dict.fromkeys(
+            (org, repo)
+            for org, repo in repos
+            if (graphqlUrl, org, repo) not in repoIdCache
+        )
+    )
+    for i in range(0, len(unknown), batchSize):
+        batch = unknown[i : i + batchSize]
+        data = client.execute(
+            query=makeGetRepoIdsQuery(batch, logger),
+            headers=ghGraphqlHeaders(ghAuthToken),
+        )
+        # Check before caching anything, so a failed query is asked again
+        raiseOnGraphqlErrors(data, f"Could not look up repos {batch}")
+        # Repos that do not exist come back as null with a NOT_FOUND error
+        found = data["data"]
+        for j, (org, repo) in enumerate(batch):
+            repoIdCache[(graphqlUrl, org, repo)] = found.get(f"r{j}")
+    return {(org, repo): repoIdCache[(graphqlUrl, org, repo)] for org, repo in repos}
+
+
+def makeGetBranchesQuery(org, repo, logger, count, qualifier=""):
+    query = """
+query Repository {
+    repository(
+        owner: "ORG"
+        name: "REPO"
+        followRenames: true
+    ) {
+        refs(
+          refPrefix: "refs/heads/",
+          QUALIFIER
+          first: COUNT) {
+            nodes {
+                name
+            }
+          pageInfo {
+            endCursor
+            hasNextPage
+         }
+        }
+    }
+}
+"""
+    repls = (
+        ("ORG", org),
+        ("REPO", repo),
+        ("COUNT", str(count)),
+        ("QUALIFIER", qualifier),
+    )
+    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+
+    logger.debug(res)
+    return res
+
+
+def getBranchNames(
+    org, repo, ghAuthToken, logger, graphqlUrl="https://api.github.com/graphql"
+):
+    """Return the set of every branch name in a repository."""
+    client = GraphqlClient(endpoint=graphqlUrl)
+    morePages = True
+    branches = set()
+    qualifier = ""
+    while morePages:
+        data = client.execute(
+            query=makeGetBranchesQuery(org, repo, logger, 100, qualifier=qualifier),
+            headers=ghGraphqlHeaders(ghAuthToken),
+        )
+        refs = data["data"]["repository"]["refs"]
+        branches.update(node["name"] for node in refs["nodes"])
+        morePages = refs["pageInfo"]["hasNextPage"]
+        if morePages:
+            qualifier = f'after: "{refs["pageInfo"]["endCursor"]}",'
+    logger.info(f"Found {len(branches)} branches in {org}/{repo}")
+    return branches
+
+
+def makeGetNumbersQuery(org, repo, logger, connection, count, qualifier=""):
+    query = """
+query Repository {
+    repository(
+        owner: "ORG"
+        name: "REPO"
+        followRenames: true
+    ) {
+        CONNECTION(
+          QUALIFIER
+          first: COUNT) {
+            nodes {
+                number
+            }
+          pageInfo {
+            endCursor
+            hasNextPage
+         }
+        }
+    }
+}
+"""
+    repls = (
+        ("ORG", org),
+        ("REPO", repo),
+        ("CONNECTION", connection),
+        ("COUNT", str(count)),
+        ("QUALIFIER", qualifier),
+    )
+    res = ft.reduce(lambda a, kv: a.replace(*kv), repls, query)
+
+    logger.debug(res)
+    return res
+
+
+def getIssueAndPrNumbers(
+    org, repo, ghAuthToken, logger, graphqlUrl="https://api.github.com/graphql"
+):
+    """Return a bitmap of every issue and pull request number in a repository.
+
+    The result is a bytearray where existing[n] is 1 if number n is taken by
+    an issue or a pull request. Numbers past the end of the array are free."""
+    client = GraphqlClient(endpoint=graphqlUrl)
+    existing = bytearray()
+    for connection in ["issues", "pullRequests"]:
+        morePages = True
+        qualifier = ""
+        while morePages:
+            data = client.execute(
+                query=makeGetNumbersQuery(
+                    org, repo, logger, connection, 100, qualifier=qualifier
+                ),
+                headers=ghGraphqlHeaders(ghAuthToken),
+            )
+            page = data["data"]["repository"][connection]
+            for node in page["nodes"]:
+                num = int(node["number"])
+                if num >= len(existing):
+                    existing.extend(bytes(num + 1 - len(existing)))
+                existing[num] = 1
+            morePages = page["pageInfo"]["hasNextPage"]
+            if morePages:
+                qualifier = f'after: "{page["pageInfo"]["endCursor"]}",'
+    logger.info(f"Found {sum(existing)} issue and PR numbers in {org}/{repo}")
+    return existing
+
+
+def getNextNumber(existing):
+    """Return the number GitHub gives the next issue or pull request, one
+    past the highest number in a getIssueAndPrNumbers bitmap."""
+    return len(existing.rstrip(b"\x00")) or 1
+
+
+def getMissingNumbers(existing, start, end):
+    return [
+        num
+        for num in range(start, end + 1)
+        if num >= len(existing) or not existing[num]
+    ]
+
+
 def createCommitQuery(
     org,
     repo,